@@ -0,0 +1,34 @@
+"""Stand-in for the yt_dlp package: every video is synthetic audio from run.py's media server."""
+import hashlib
+import os
+import time
+
+MEDIA_URL = os.environ.get("BENCH_MEDIA_URL", "http://127.0.0.1:9")
+AUDIO_SECONDS = float(os.environ.get("BENCH_AUDIO_SECONDS", "180"))
+# Simulated extraction time
+EXTRACT_SECONDS = float(os.environ.get("BENCH_EXTRACT_SECONDS", "0"))
+
+
+class YoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url, download=False):
+        if EXTRACT_SECONDS:
+            time.sleep(EXTRACT_SECONDS)
+        video_id = url.rstrip("/")[-11:] if len(url) >= 11 else hashlib.sha1(url.encode()).hexdigest()[:11]
+        audio = {
+            "format_id": "bench",
+            "ext": "wav",
+            "acodec": "pcm_s16le",
+            "vcodec": "none",
+            "abr": 1536,
+            "url": f"{MEDIA_URL}/audio/{video_id}.wav?expire={int(time.time()) + 6 * 3600}",
+        }
+        return dict(audio, id=video_id, title=f"Bench {video_id}", duration=AUDIO_SECONDS, formats=[audio])
@@ -0,0 +1,374 @@
+"""Offline load benchmark for the converter API.
+
+Starts the app under uvicorn with stub yt-dlp/ffmpeg executables (see
+stubs/) and a stand-in yt_dlp package (see fake_yt_dlp/), so nothing
+touches the network. The stubs produce synthetic audio served at a
+controlled size and rate. Then N client threads put load on
+/start_conversion or /stream_conversion, and the script reports jobs per
+second, latency percentiles, peak RSS and the bytes copied through
+Python. Each run is saved as JSON under results/ for later comparison.
+
+    python bench/run.py --clients 8 --requests 64 --audio-seconds 60
+    python bench/run.py --endpoint stream --source-rate 2000000 --env PIPELINE_MODE=relay
+    python bench/run.py --source-rate 2000000 --env DOWNLOADER=ranged
+    python bench/run.py --real-ffmpeg --label real-encode
+    python bench/run.py --compare results/a.json results/b.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+sys.path.insert(0, BENCH_DIR)
+import synth  # noqa: E402
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", choices=("conversion", "stream"), default="conversion")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent client threads")
+    parser.add_argument("--requests", type=int, default=32, help="total requests")
+    parser.add_argument("--distinct", type=int, help="distinct videos requested (default: one per request)")
+    parser.add_argument("--format", default="mp3")
+    parser.add_argument("--bitrate")
+    parser.add_argument("--audio-seconds", type=float, default=60, help="length of each synthetic video")
+    parser.add_argument("--source-rate", type=float, default=0, help="download rate per video in bytes/s (0: unlimited)")
+    parser.add_argument("--encode-speed", type=float, default=0, help="stub encode speed, x real time (0: unlimited)")
+    parser.add_argument("--extract-seconds", type=float, default=0, help="simulated metadata extraction time")
+    parser.add_argument("--real-ffmpeg", action="store_true", help="use the ffmpeg on PATH instead of the stub")
+    parser.add_argument("--no-download", action="store_true", help="don't fetch finished conversions")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="seconds between job status polls")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="server setting, e.g. ENCODE_WORKERS=2")
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output", help="result file (default: results/<time>-<label>.json)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="print saved results side by side and exit")
+    return parser.parse_args(argv)
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves synthetic audio for stream URLs and an empty proxy list.
+
+    Audio supports single byte ranges over keep-alive connections, like
+    googlevideo; --source-rate then applies per connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/audio/"):
+            size = synth.wav_size()
+            start, end = 0, size - 1
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or end), end)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            try:
+                for chunk in synth.synthetic_wav(start=start, end=end):
+                    self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+    return {
+        "p50": rank(50), "p90": rank(90), "p99": rank(99),
+        "max": values[-1], "mean": sum(values) / len(values),
+    }
+
+
+def scrape_metrics(base_url):
+    """Sum each metric in /metrics over its labels."""
+    totals = {}
+    for line in requests.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        name = name.split("{", 1)[0]
+        try:
+            totals[name] = totals.get(name, 0.0) + float(value)
+        except ValueError:
+            continue
+    return totals
+
+
+def peak_rss_kb(pid):
+    """High-water RSS of a running process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def start_server(args, workdir, media_url):
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir)
+    stubs = ["yt-dlp"] if args.real_ffmpeg else ["yt-dlp", "ffmpeg"]
+    for name in stubs:
+        os.symlink(os.path.join(BENCH_DIR, "stubs", name), os.path.join(bin_dir, name))
+    if args.real_ffmpeg and not shutil.which("ffmpeg"):
+        raise SystemExit("--real-ffmpeg needs ffmpeg on PATH")
+
+    port = free_port()
+    env = dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        PYTHONPATH=os.path.join(BENCH_DIR, "fake_yt_dlp"),
+        CACHE_DIR=os.path.join(workdir, "cache"),
+        WORK_DIR=workdir,
+        PROXY_LIST_URL=f"{media_url}/proxies",
+        BENCH_MEDIA_URL=media_url,
+        BENCH_AUDIO_SECONDS=str(args.audio_seconds),
+        BENCH_SOURCE_RATE=str(args.source_rate),
+        BENCH_ENCODE_SPEED=str(args.encode_speed),
+        BENCH_EXTRACT_SECONDS=str(args.extract_seconds),
+    )
+    env.pop("JOB_STORE_PATH", None)
+    env.pop("JOB_QUEUE_PATH", None)
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        env[key] = value
+
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited; see {log.name}")
+        try:
+            requests.get(f"{base_url}/metrics", timeout=1)
+            return server, base_url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("Server did not start within 30 seconds")
+
+
+_local = threading.local()
+
+
+def session():
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def run_conversion(base_url, video_url, args):
+    s = session()
+    body = {"youtube_url": video_url, "format": args.format}
+    if args.bitrate:
+        body["bitrate"] = args.bitrate
+    start = time.perf_counter()
+    r = s.post(f"{base_url}/start_conversion", json=body, timeout=60)
+    if r.status_code == 429:
+        return {"outcome": "rejected", "latency": time.perf_counter() - start}
+    job_id = r.json()["job_id"]
+    while True:
+        job = s.get(f"{base_url}/job_status/{job_id}", timeout=60).json()
+        if job.get("status") in ("done", "error"):
+            break
+        time.sleep(args.poll_interval)
+    received = 0
+    if job["status"] == "done" and not args.no_download:
+        with s.get(f"{base_url}{job['download_url']}", stream=True, timeout=60) as download:
+            for chunk in download.iter_content(64 * 1024):
+                received += len(chunk)
+    outcome = "ok" if job["status"] == "done" else "error"
+    return {"outcome": outcome, "latency": time.perf_counter() - start, "bytes": received, "error": job.get("error")}
+
+
+def run_stream(base_url, video_url, args):
+    s = session()
+    params = {"youtube_url": video_url, "format": args.format}
+    if args.bitrate:
+        params["bitrate"] = args.bitrate
+    start = time.perf_counter()
+    first_byte = None
+    received = 0
+    with s.get(f"{base_url}/stream_conversion", params=params, stream=True, timeout=60) as r:
+        if r.status_code == 429:
+            return {"outcome": "rejected", "latency": time.perf_counter() - start}
+        for chunk in r.iter_content(64 * 1024):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            received += len(chunk)
+        ok = r.ok and received and r.headers.get("content-type", "").startswith("audio/")
+    return {
+        "outcome": "ok" if ok else "error", "latency": time.perf_counter() - start,
+        "first_byte": first_byte, "bytes": received,
+    }
+
+
+def run(args):
+    distinct = args.distinct or args.requests
+    # 11 characters, so the app treats them as YouTube video IDs
+    videos = [f"https://youtu.be/b{secrets.token_hex(5)}" for _ in range(distinct)]
+    workdir = tempfile.mkdtemp(prefix="converter-bench-")
+
+    media = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    media.daemon_threads = True
+    threading.Thread(target=media.serve_forever, daemon=True).start()
+    media_url = f"http://127.0.0.1:{media.server_address[1]}"
+    os.environ["BENCH_AUDIO_SECONDS"] = str(args.audio_seconds)
+    os.environ["BENCH_SOURCE_RATE"] = str(args.source_rate)
+    synth.AUDIO_SECONDS, synth.SOURCE_RATE = args.audio_seconds, args.source_rate
+
+    server, base_url = start_server(args, workdir, media_url)
+    try:
+        before = scrape_metrics(base_url)
+        request = run_stream if args.endpoint == "stream" else run_conversion
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as pool:
+            results = list(pool.map(lambda i: request(base_url, videos[i % distinct], args), range(args.requests)))
+        wall = time.perf_counter() - started
+        after = scrape_metrics(base_url)
+        server_rss = peak_rss_kb(server.pid)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        media.shutdown()
+        shutil.rmtree(os.path.join(workdir, "cache"), ignore_errors=True)
+
+    def delta(name):
+        return after.get(name, 0.0) - before.get(name, 0.0)
+
+    ok = [r for r in results if r["outcome"] == "ok"]
+    errors = [r for r in results if r["outcome"] == "error"]
+    first_bytes = [r["first_byte"] for r in ok if r.get("first_byte") is not None]
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(errors),
+        "rejected": sum(r["outcome"] == "rejected" for r in results),
+        "first_error": next((r.get("error") for r in errors if r.get("error")), None),
+        "wall_seconds": wall,
+        "jobs_per_second": len(ok) / wall if wall else None,
+        "latency_seconds": percentiles([r["latency"] for r in ok]),
+        "first_byte_seconds": percentiles(first_bytes),
+        "bytes_received": sum(r.get("bytes", 0) for r in results),
+        "bytes_piped": delta("converter_piped_bytes_total"),
+        "bytes_through_python": delta("converter_relayed_bytes_total"),
+        "server_peak_rss_kb": server_rss,
+        # ru_maxrss of reaped descendants: the largest single one (server, yt-dlp or ffmpeg)
+        "max_process_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "workdir": workdir,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(paths):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    rows = [
+        ("label", lambda r: r["label"]),
+        ("commit", lambda r: r["commit"]),
+        ("endpoint", lambda r: r["config"]["endpoint"]),
+        ("clients", lambda r: r["config"]["clients"]),
+        ("ok/requests", lambda r: f"{r['results']['ok']}/{r['results']['requests']}"),
+        ("jobs/s", lambda r: r["results"]["jobs_per_second"]),
+        ("p50 s", lambda r: (r["results"]["latency_seconds"] or {}).get("p50")),
+        ("p99 s", lambda r: (r["results"]["latency_seconds"] or {}).get("p99")),
+        ("ttfb p50 s", lambda r: (r["results"]["first_byte_seconds"] or {}).get("p50")),
+        ("server RSS MB", lambda r: (r["results"]["server_peak_rss_kb"] or 0) / 1024),
+        ("python MB", lambda r: r["results"]["bytes_through_python"] / 1e6),
+    ]
+    for name, get in rows:
+        cells = []
+        for r in runs:
+            value = get(r)
+            cells.append(f"{value:.3f}" if isinstance(value, float) else str(value))
+        print(f"{name:<15}" + "".join(f"{cell:>16}" for cell in cells))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(args.compare)
+        return
+
+    record = {
+        "label": args.label,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "host": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "output")},
+    }
+    record["results"] = run(args)
+
+    path = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{args.label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+    print(json.dumps(record["results"], indent=2))
+    print(f"Saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
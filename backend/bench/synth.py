@@ -0,0 +1,68 @@
+"""Synthetic audio for the benchmark stubs: a 440 Hz tone as 16-bit stereo WAV."""
+import array
+import math
+import os
+import struct
+import sys
+import time
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+BYTE_RATE = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+HEADER_SIZE = 44
+CHUNK_SIZE = 64 * 1024
+
+# Knobs shared by the stubs and the media server, set by run.py
+AUDIO_SECONDS = float(os.environ.get("BENCH_AUDIO_SECONDS", "180"))
+SOURCE_RATE = float(os.environ.get("BENCH_SOURCE_RATE", "0"))  # bytes/s served, 0 for unlimited
+
+
+def _one_second():
+    samples = array.array("h")
+    for i in range(SAMPLE_RATE):
+        value = int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE))
+        samples.extend((value, value))
+    if sys.byteorder != "little":
+        samples.byteswap()
+    return samples.tobytes()
+
+
+_SECOND = _one_second()
+
+
+def wav_size(seconds=None):
+    seconds = AUDIO_SECONDS if seconds is None else seconds
+    return HEADER_SIZE + int(seconds * SAMPLE_RATE) * CHANNELS * SAMPLE_WIDTH
+
+
+def wav_header(seconds=None):
+    data_size = wav_size(seconds) - HEADER_SIZE
+    return (
+        b"RIFF" + struct.pack("<I", data_size + 36) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, CHANNELS, SAMPLE_RATE, BYTE_RATE, CHANNELS * SAMPLE_WIDTH, 8 * SAMPLE_WIDTH)
+        + b"data" + struct.pack("<I", data_size)
+    )
+
+
+def synthetic_wav(seconds=None, rate=None, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """Yield bytes ``start`` to ``end`` (inclusive, default the whole file) of a
+    WAV file of ``seconds`` of tone, at most ``rate`` bytes per second."""
+    seconds = AUDIO_SECONDS if seconds is None else seconds
+    rate = SOURCE_RATE if rate is None else rate
+    stop = wav_size(seconds) if end is None else end + 1
+    sent = start
+    if sent < HEADER_SIZE:
+        header = wav_header(seconds)[sent:min(stop, HEADER_SIZE)]
+        yield header
+        sent += len(header)
+    began = time.monotonic()
+    while sent < stop:
+        offset = (sent - HEADER_SIZE) % len(_SECOND)
+        n = min(chunk_size, stop - sent, len(_SECOND) - offset)
+        yield _SECOND[offset:offset + n]
+        sent += n
+        if rate:
+            ahead = (sent - start) / rate - (time.monotonic() - began)
+            if ahead > 0:
+                time.sleep(ahead)
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import re
+import time
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Where finished conversions live and how much disk they may use before
+# the least recently used files are evicted.
+CACHE_DIR = os.environ.get("CACHE_DIR", "/tmp/mp3cache")
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(5 * 1024 ** 3)))  # 5 GB
+
+_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+
+def extract_video_id(youtube_url):
+    """Return the 11 character YouTube video ID for a URL, or None."""
+    url = youtube_url.strip()
+    if _VIDEO_ID_RE.match(url):
+        return url
+    if "://" not in url:
+        url = f"https://{url}"
+
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    path_parts = [part for part in parsed.path.split("/") if part]
+
+    candidate = None
+    if host == "youtu.be" or host.endswith(".youtu.be"):
+        candidate = path_parts[0] if path_parts else None
+    elif host == "youtube.com" or host.endswith(".youtube.com") or host == "youtube-nocookie.com" or host.endswith(".youtube-nocookie.com"):
+        query = parse_qs(parsed.query)
+        if "v" in query:
+            candidate = query["v"][0]
+        elif len(path_parts) >= 2 and path_parts[0] in ("shorts", "embed", "live", "v", "e"):
+            candidate = path_parts[1]
+
+    if candidate and _VIDEO_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def cache_key(youtube_url, codec, bitrate):
+    """Build a filesystem-safe cache key from the video and output parameters."""
+    video_id = extract_video_id(youtube_url)
+    if not video_id:
+        # Not a recognisable YouTube URL; fall back to the exact URL
+        video_id = "url_" + hashlib.sha1(youtube_url.strip().encode()).hexdigest()[:16]
+    return f"{video_id}-{codec}-{bitrate}"
+
+
+class ConversionCache:
+    """Content-addressed store of finished conversions with LRU eviction.
+
+    Files are named ``{key}.{ext}``. A file's atime is bumped on every hit
+    so eviction can drop the least recently used files first; the mtime is
+    left alone so it stays usable as Last-Modified.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path_for(self, key, ext="mp3"):
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def contains_path(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory)
+
+    def lookup(self, key, ext="mp3"):
+        """Return the cached file path for ``key`` and mark it as recently used."""
+        path = self.path_for(key, ext)
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, src_path, key, ext="mp3"):
+        """Move a finished file into the cache and enforce the disk budget."""
+        path = self.place(src_path, key, ext)
+        self.evict(keep=path)
+        return path
+
+    def place(self, src_path, key, ext="mp3"):
+        """Move a finished file into the cache, leaving the budget to a later ``evict``.
+
+        Only a rename, so it is cheap enough for the event loop.
+        """
+        path = self.path_for(key, ext)
+        os.replace(src_path, path)
+        logger.info(f"Cached {path} ({os.path.getsize(path)} bytes).")
+        return path
+
+    def evict(self, keep=None):
+        """Delete least recently used files until the cache fits its budget."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted {path} from cache ({size} bytes).")
+            except FileNotFoundError:
+                total -= size
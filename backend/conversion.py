@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import os
+import time
+
+from cache import ConversionCache, cache_key
+from downloader import DOWNLOADER, DownloadError, RangedDownloader
+from formats import OUTPUT_FORMATS, can_copy, ffmpeg_output_args, rendition_name, requested_bitrate, source_selector
+from job_store import create_job_store
+from metadata import MetadataCache
+from metrics import (
+    BYTES_PIPED, BYTES_RELAYED, ENCODE_DURATION, FIRST_BYTE, JOB_OUTCOMES, QUEUE_WAIT, SPAWN_LATENCY,
+    TRANSFER_DURATION, register_proxy_pool, track_scheduler,
+)
+from pipeline import FFMPEG_PROGRESS_ARGS, YT_DLP_PROGRESS_ARGS, run_feed, run_pipeline, start_ffmpeg, start_pipeline
+from proxy_pool import ProxyPool
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+# Path to your exported cookies file (Netscape format)
+COOKIES_FILE = "cookies.txt"
+
+# Job records, shared with the API through JOB_STORE_PATH when workers run separately
+job_store = create_job_store()
+PROGRESS_UPDATE_INTERVAL = 0.5  # seconds between progress writes to the job store
+
+conversion_cache = ConversionCache()
+# Where conversions are written while they run; shared with the API for progressive downloads
+WORK_DIR = os.environ.get("WORK_DIR", "/tmp")
+
+# Decides when queued conversions run; sized by DOWNLOAD_WORKERS/ENCODE_WORKERS
+scheduler = Scheduler()
+track_scheduler(scheduler)
+
+# Proxies for yt-dlp, health-checked and scored in the background
+proxy_pool = ProxyPool()
+register_proxy_pool(proxy_pool)
+PROXY_REFRESH_INTERVAL = 3600  # 1 hour
+
+# Title, formats and stream URLs, extracted in-process and cached until the URLs expire
+metadata_cache = MetadataCache(proxy_pool, COOKIES_FILE)
+
+# Job ID -> task, for conversions running in this process
+running_conversions = {}
+# Cancelled jobs whose outputs now belong to another worker
+_keep_outputs = set()
+
+
+def output_cache_key(youtube_url, output_format, bitrate, normalize=False):
+    return cache_key(youtube_url, output_format, (bitrate or "auto") + ("-norm" if normalize else ""))
+
+
+def describe_output(youtube_url, output_format, bitrate, normalize=False):
+    """The cache key, name and file extension of one requested output."""
+    bitrate = requested_bitrate(output_format, bitrate)
+    return {
+        "name": rendition_name(output_format, bitrate, normalize),
+        "format": output_format,
+        "bitrate": bitrate,
+        "normalize": normalize,
+        "ext": OUTPUT_FORMATS[output_format]["ext"],
+        "cache_key": output_cache_key(youtube_url, output_format, bitrate, normalize),
+    }
+
+
+def scheduler_stages(outputs):
+    """Scheduler stages to admit a job for ``outputs`` with.
+
+    A job whose outputs could all be remuxed starts with a download slot
+    only; ``_convert`` acquires an encode slot if the plan transcodes after all.
+    """
+    if all(o["bitrate"] is None and not o["normalize"] for o in outputs):
+        return ("download",)
+    return ("download", "encode")
+
+
+async def plan_outputs(youtube_url, outputs):
+    """Decide how to produce ``outputs`` from a single download.
+
+    An output can be remuxed (-c:a copy) when it leaves the bitrate open,
+    isn't normalized and the source codec fits its container. The source
+    is chosen to allow that for the first output that could use it; every
+    other output is transcoded. Returns the yt-dlp format selector, the
+    metadata it was based on (if any) and the selector that metadata was
+    extracted with, and per output whether to copy and at what bitrate to
+    encode.
+    """
+    remuxable = [o for o in outputs if o["bitrate"] is None and not o["normalize"]]
+    info = None
+    info_selector = "bestaudio"
+    if remuxable:
+        info_selector = source_selector(remuxable[0]["format"], None)
+        info = await metadata_cache.extract(youtube_url, info_selector)
+    planned = []
+    for output in outputs:
+        copy = output in remuxable and can_copy(output["format"], info.get("acodec"))
+        bitrate = None if copy else output["bitrate"] or OUTPUT_FORMATS[output["format"]]["fallback_bitrate"]
+        planned.append(dict(output, copy=copy, bitrate=bitrate))
+    selector = info.get("format_id") if info else None
+    return {"selector": selector or "bestaudio", "info": info, "info_selector": info_selector, "outputs": planned}
+
+
+def discard_outputs(outputs):
+    """Delete whatever a failed conversion wrote."""
+    for output in outputs:
+        try:
+            os.remove(output["file_path"])
+        except FileNotFoundError:
+            pass
+
+
+async def stop_processes(*processes):
+    """Kill and reap whichever of ``processes`` were started and are still running."""
+    processes = [process for process in processes if process]
+    for process in processes:
+        process.kill()
+    for process in processes:
+        await process.wait()
+
+
+async def refresh_proxies():
+    """Load proxies and refresh them every PROXY_REFRESH_INTERVAL."""
+    while True:
+        count = await proxy_pool.refresh()
+        logger.info(f"Refreshed proxies: {count} available.")
+        await asyncio.sleep(PROXY_REFRESH_INTERVAL)
+
+
+def cancel_conversion(job_id, keep_outputs=False):
+    """Stop ``job_id`` if it runs in this process. Its processes are killed and reaped.
+
+    What it wrote so far is deleted, unless ``keep_outputs`` is set
+    because another worker has taken the job over and writes there now.
+    """
+    task = running_conversions.pop(job_id, None)
+    if task is None:
+        return False
+    if keep_outputs:
+        _keep_outputs.add(job_id)
+    task.cancel()
+    return True
+
+
+async def convert_youtube_to_mp3(youtube_url, job_id, outputs, download=None):
+    """Download ``youtube_url`` once and write each of ``outputs`` in a single ffmpeg pass.
+
+    ``download`` overrides RangedDownloader settings for this job. The
+    work runs in its own task so that ``cancel_conversion`` can stop it
+    without cancelling the caller.
+    """
+    job = await job_store.get(job_id)
+    if not job or job.get("cancelled"):
+        logger.info(f"Job {job_id}: Cancelled before it started.")
+        scheduler.withdraw(job_id)
+        return
+    task = asyncio.create_task(_convert(youtube_url, job_id, outputs, download))
+    running_conversions[job_id] = task
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Still registered: it was the caller that was cancelled
+        if running_conversions.get(job_id) is task:
+            raise
+        logger.info(f"Job {job_id}: Cancelled.")
+    finally:
+        if running_conversions.get(job_id) is task:
+            del running_conversions[job_id]
+
+
+async def _convert(youtube_url, job_id, outputs, download):
+    async with scheduler.run(job_id) as queue_wait:
+        # From the spawn on, a cancellation or error anywhere must not leave them running
+        yt_dlp_process = ffmpeg_process = None
+        try:
+            start_time = time.time()
+            logger.info(f"Job {job_id}: Starting conversion process after {queue_wait:.2f} seconds in the queue.")
+            QUEUE_WAIT.labels("job").observe(queue_wait)
+
+            # Remux instead of transcoding when the source codec allows it
+            plan = await plan_outputs(youtube_url, outputs)
+            for output in plan["outputs"]:
+                logger.info(f"Job {job_id}: {'Remuxing' if output['copy'] else 'Transcoding'} format {plan['selector']} to {output['name']}.")
+            if not all(output["copy"] for output in plan["outputs"]):
+                await scheduler.acquire(job_id, "encode")
+
+            # One decode feeds every output: -map the audio once per target
+            output_args = []
+            for output in plan["outputs"]:
+                output_args += [
+                    "-map", "0:a",
+                    *ffmpeg_output_args(output["format"], output["bitrate"], output["copy"], normalize=output["normalize"]),
+                    output["file_path"],
+                ]
+            # -y: a retried job finds its earlier attempt's files, and with
+            # stdin as the input ffmpeg can't ask whether to overwrite them
+            ffmpeg_command = ["ffmpeg", "-y", "-i", "pipe:0", *FFMPEG_PROGRESS_ARGS, *output_args]
+
+            # With DOWNLOADER=ranged, fetch the resolved stream URL here in
+            # parallel ranges, through the proxy it was resolved with: the
+            # URL is only valid from that IP
+            info = None
+            if DOWNLOADER == "ranged":
+                info = plan["info"] or await metadata_cache.extract(youtube_url, plan["info_selector"])
+                if "\n" in info["url"]:
+                    info = None  # Separate streams to merge; leave that to yt-dlp
+
+            step_start = time.time()
+            if info:
+                proxy = info["proxy"]
+                downloader = RangedDownloader.for_proxy(proxy, **(download or {}))
+                logger.info(f"Job {job_id}: Downloading over {downloader.connections} connections via proxy {proxy}.")
+                yt_dlp_process = None
+                ffmpeg_process = await start_ffmpeg(ffmpeg_command)
+            else:
+                # Pick a proxy from the pool
+                proxy = proxy_pool.pick()
+                proxy_flag = ['--proxy', proxy] if proxy else []
+                logger.info(f"Job {job_id}: Using proxy {proxy}.")
+
+                # Start yt-dlp and ffmpeg, connected by a pipe
+                yt_dlp_process, ffmpeg_process = await start_pipeline(
+                    [
+                        "yt-dlp", "-f", plan["selector"], "--no-playlist", "-o", "-", "--http-chunk-size", "10M", "--cookies", COOKIES_FILE, youtube_url,
+                        *YT_DLP_PROGRESS_ARGS,
+                        *proxy_flag,  # Add proxy flag
+                    ],
+                    ffmpeg_command,
+                )
+            logger.info(f"Job {job_id}: yt-dlp and ffmpeg processes started. Time taken: {time.time() - step_start:.2f} seconds.")
+            SPAWN_LATENCY.labels("job").observe(time.time() - step_start)
+            job = await job_store.get(job_id)
+            renditions = job.get("renditions")
+            if renditions:
+                for output in plan["outputs"]:
+                    renditions[output["name"]]["remux"] = output["copy"]
+            await job_store.update(
+                job_id, status="converting", remux=plan["outputs"][0]["copy"],
+                **({"renditions": renditions} if renditions else {}),
+            )
+
+            # Report progress, at most every PROGRESS_UPDATE_INTERVAL seconds.
+            # Encoded time over duration is the better measure once yt-dlp
+            # has told us the duration; before that, fall back to bytes.
+            state = {"downloaded_bytes": 0, "total_bytes": None, "duration": None, "encoded_seconds": 0.0, "output_bytes": 0}
+            last_update = 0.0
+            pending_update = None
+
+            def publish_progress():
+                # Called from the readers' callbacks; the store write runs as a
+                # task, one at a time, so a slow store can't stall the pipes
+                nonlocal last_update, pending_update
+                now = time.time()
+                if now - last_update < PROGRESS_UPDATE_INTERVAL or (pending_update and not pending_update.done()):
+                    return
+                last_update = now
+                if state["duration"]:
+                    progress = state["encoded_seconds"] * 100 / state["duration"]
+                elif state["total_bytes"]:
+                    progress = state["downloaded_bytes"] * 100 / state["total_bytes"]
+                else:
+                    progress = 0
+                pending_update = asyncio.create_task(job_store.update(job_id, progress=min(99, int(progress)), **state))
+
+            def on_progress(downloaded, total, duration):
+                state.update(downloaded_bytes=downloaded, total_bytes=total, duration=duration or state["duration"])
+                publish_progress()
+
+            def on_encode_progress(encoded_seconds, output_bytes, finished):
+                if encoded_seconds is not None:
+                    state["encoded_seconds"] = encoded_seconds
+                if output_bytes is not None:
+                    state["output_bytes"] = output_bytes
+                publish_progress()
+
+            # Wait for the data to flow through
+            step_start = time.time()
+            if yt_dlp_process:
+                result = await run_pipeline(yt_dlp_process, ffmpeg_process, on_progress, on_encode_progress)
+                source_ok = yt_dlp_process.returncode == 0
+            else:
+                try:
+                    result = await run_feed(
+                        downloader.stream(info["url"]), ffmpeg_process, info.get("filesize"),
+                        duration=info.get("duration"), on_progress=on_progress, on_encode_progress=on_encode_progress,
+                    )
+                except DownloadError:
+                    # Expired or refused; make the next job resolve a fresh URL
+                    metadata_cache.invalidate(youtube_url, plan["info_selector"])
+                    if proxy:
+                        proxy_pool.report_failure(proxy)
+                    raise
+                source_ok = True
+            if pending_update:
+                await pending_update
+            logger.info(f"Job {job_id}: {result['bytes']} bytes piped in {time.time() - step_start:.2f} seconds.")
+            BYTES_PIPED.inc(result["bytes"])
+            BYTES_RELAYED.labels("job").inc(result["relayed_bytes"])
+            TRANSFER_DURATION.observe(result["transfer_seconds"])
+            ENCODE_DURATION.observe(result["encode_seconds"])
+            if result["first_byte_seconds"] is not None:
+                FIRST_BYTE.observe(result["first_byte_seconds"])
+            if proxy:
+                if source_ok:
+                    proxy_pool.report_success(proxy, latency=result["first_byte_seconds"])
+                else:
+                    proxy_pool.report_failure(proxy)
+
+            # ffmpeg finishes cleanly on a truncated input, so a failed
+            # download must not be cached as if it were the whole video
+            if yt_dlp_process and yt_dlp_process.returncode != 0:
+                error = yt_dlp_process.error or f"yt-dlp failed: {result['yt_dlp_stderr'] or 'Unknown error'}"
+                logger.error(f"Job {job_id}: {error}")
+                discard_outputs(outputs)
+                await job_store.update(job_id, status="error", error=error)
+                JOB_OUTCOMES.labels("error").inc()
+                return
+
+            stderr = result["ffmpeg_stderr"]
+            if stderr:
+                logger.error(f"Job {job_id}: ffmpeg stderr: {stderr}")
+            if ffmpeg_process.returncode != 0:
+                logger.error(f"Job {job_id}: ffmpeg failed with return code {ffmpeg_process.returncode}")
+                discard_outputs(outputs)
+                # A timeout explains the failure better than the stderr of a killed process
+                error = ffmpeg_process.error or f"ffmpeg failed: {stderr or 'Unknown error'}"
+                await job_store.update(job_id, status="error", error=error)
+                JOB_OUTCOMES.labels("error").inc()
+                return
+
+            # Check if the files were created
+            missing = [o["file_path"] for o in outputs if not os.path.exists(o["file_path"])]
+            if missing:
+                logger.error(f"Job {job_id}: File not created at {', '.join(missing)}")
+                await job_store.update(job_id, status="error", error="File creation failed")
+                JOB_OUTCOMES.labels("error").inc()
+                return
+
+            job = await job_store.get(job_id)
+            file_paths = job["file_paths"]
+            renditions = job.get("renditions")
+            for output in outputs:
+                logger.info(f"Job {job_id}: File created successfully at {output['file_path']}")
+                cached_path = await asyncio.to_thread(conversion_cache.store, output["file_path"], output["cache_key"], output["ext"])
+                file_paths[output["filename"]] = cached_path
+                if renditions:
+                    renditions[output["name"]]["download_url"] = f"/download/{os.path.basename(cached_path)}"
+            # The first output is the job's download, unless it was cached already
+            primary = {}
+            if not job.get("download_url"):
+                cached_path = file_paths[outputs[0]["filename"]]
+                primary = {"file_path": cached_path, "download_url": f"/download/{os.path.basename(cached_path)}"}
+            await job_store.update(
+                job_id, status="done", progress=100, file_paths=file_paths,
+                **dict(state, downloaded_bytes=result["bytes"]),
+                **({"renditions": renditions} if renditions else {}),
+                **primary,
+            )
+            JOB_OUTCOMES.labels("done").inc()
+        except asyncio.CancelledError:
+            await stop_processes(yt_dlp_process, ffmpeg_process)
+            if job_id in _keep_outputs:
+                _keep_outputs.discard(job_id)
+            else:
+                discard_outputs(outputs)
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id}: Conversion failed: {str(e)}")
+            await stop_processes(yt_dlp_process, ffmpeg_process)
+            discard_outputs(outputs)
+            await job_store.update(job_id, status="error", error=str(e))
+            JOB_OUTCOMES.labels("error").inc()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from scheduler import DOWNLOAD_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# "yt-dlp" lets yt-dlp download the audio; "ranged" resolves the stream URL
+# in-process and fetches it with RangedDownloader instead
+DOWNLOADER = os.environ.get("DOWNLOADER", "yt-dlp")
+# Ranges fetched at once, and their size. At most connections * chunk_size
+# bytes are held in memory per download.
+RANGE_CONNECTIONS = int(os.environ.get("RANGE_CONNECTIONS", "4"))
+RANGE_CHUNK_SIZE = int(os.environ.get("RANGE_CHUNK_SIZE", str(2 * 1024 * 1024)))
+RANGE_MAX_CONNECTIONS = 16
+RANGE_RETRIES = 3
+RANGE_TIMEOUT = 30  # seconds per request
+# Per-proxy overrides as JSON, e.g. {"http://10.0.0.1:3128": {"connections": 2}};
+# "direct" applies when no proxy is used
+RANGE_TUNING = json.loads(os.environ.get("RANGE_TUNING", "{}"))
+# Threads for blocking requests, shared by every download: enough for each
+# download slot to keep its ranges in flight. Past that, ranges wait their turn.
+RANGE_THREADS = int(os.environ.get("RANGE_THREADS", str(DOWNLOAD_WORKERS * RANGE_CONNECTIONS)))
+# Keep-alive connection pools, one per proxy
+MAX_SESSIONS = 64
+
+# Not the default executor: metadata extraction, proxy checks and cache
+# moves share that, and it is much smaller than RANGE_THREADS
+_executor = ThreadPoolExecutor(max_workers=RANGE_THREADS, thread_name_prefix="range-fetch")
+
+
+class DownloadError(Exception):
+    """Raised when a stream URL can't be fetched."""
+
+
+_sessions = OrderedDict()  # proxy -> requests.Session
+
+
+def session_for(proxy):
+    """A shared session whose connections to the stream host are reused across downloads."""
+    session = _sessions.get(proxy)
+    if session is None:
+        session = requests.Session()
+        # A pool may serve every download thread at once; a smaller one
+        # would close connections as soon as they are returned
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=RANGE_THREADS, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if proxy:
+            session.proxies = {"http": proxy, "https": proxy}
+        _sessions[proxy] = session
+        while len(_sessions) > MAX_SESSIONS:
+            _, evicted = _sessions.popitem(last=False)
+            evicted.close()
+    _sessions.move_to_end(proxy)
+    return session
+
+
+def _in_thread(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+class RangedDownloader:
+    """Fetches a URL as byte ranges over several pooled connections.
+
+    Servers like googlevideo throttle each connection, so ``connections``
+    ranges of ``chunk_size`` bytes are requested in parallel, each on a
+    thread of the downloader's own pool, and handed back in order. A server that ignores Range
+    is read in one piece instead.
+    """
+
+    def __init__(self, proxy=None, connections=RANGE_CONNECTIONS, chunk_size=RANGE_CHUNK_SIZE,
+                 retries=RANGE_RETRIES, timeout=RANGE_TIMEOUT):
+        self.proxy = proxy
+        self.connections = max(1, min(connections, RANGE_MAX_CONNECTIONS))
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.session = session_for(proxy)
+
+    @classmethod
+    def for_proxy(cls, proxy, **overrides):
+        """A downloader with RANGE_TUNING for ``proxy``, then ``overrides`` (e.g. per job), applied."""
+        settings = dict(RANGE_TUNING.get(proxy or "direct", {}))
+        settings.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(proxy, **settings)
+
+    def _probe(self, url):
+        """Return the size of ``url``, or None if the server doesn't support ranges."""
+        with self.session.get(url, headers={"Range": "bytes=0-0"}, timeout=self.timeout, stream=True) as r:
+            if r.status_code in (403, 404, 410):
+                raise DownloadError(f"HTTP {r.status_code} for stream URL")
+            content_range = r.headers.get("Content-Range", "")
+            if r.status_code != 206 or "/" not in content_range:
+                return None
+            total = content_range.rsplit("/", 1)[1]
+            return int(total) if total.isdigit() else None
+
+    def _fetch_range(self, url, start, end):
+        delay = 0.5
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.get(url, headers={"Range": f"bytes={start}-{end}"}, timeout=self.timeout)
+                if r.status_code in (403, 404, 410):
+                    # Expired or bound to another IP; retrying won't help
+                    raise DownloadError(f"HTTP {r.status_code} for bytes {start}-{end}")
+                if r.status_code != 206 or len(r.content) != end - start + 1:
+                    raise requests.RequestException(f"HTTP {r.status_code}, {len(r.content)} bytes for {start}-{end}")
+                return r.content
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise DownloadError(f"Bytes {start}-{end} failed after {attempt + 1} attempts: {e}")
+                logger.warning(f"Retrying bytes {start}-{end} ({e}).")
+                time.sleep(delay)
+                delay *= 2
+
+    async def _stream_whole(self, url):
+        response = await _in_thread(lambda: self.session.get(url, timeout=self.timeout, stream=True))
+        try:
+            if response.status_code != 200:
+                raise DownloadError(f"HTTP {response.status_code} for stream URL")
+            chunks = response.iter_content(64 * 1024)
+            while chunk := await _in_thread(next, chunks, None):
+                yield chunk
+        finally:
+            response.close()
+
+    async def stream(self, url, size=None):
+        """Yield the body of ``url`` in order. ``size`` saves a request when it is known."""
+        size = size or await _in_thread(self._probe, url)
+        if not size:
+            logger.info("Stream URL doesn't support ranges; downloading it over one connection.")
+            async for chunk in self._stream_whole(url):
+                yield chunk
+            return
+
+        ranges = deque((start, min(start + self.chunk_size, size) - 1) for start in range(0, size, self.chunk_size))
+        pending = deque()
+        try:
+            while ranges or pending:
+                # Keep the pipe full, but never more than `connections` ranges ahead
+                while ranges and len(pending) < self.connections:
+                    start, end = ranges.popleft()
+                    pending.append(_in_thread(self._fetch_range, url, start, end))
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
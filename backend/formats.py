@@ -0,0 +1,89 @@
+import os
+
+# Output formats clients can ask for. "copy_acodecs" are source codecs that
+# can go into the container as-is (ffmpeg -c:a copy), and "source" is the
+# yt-dlp format selector that prefers such a source. A bitrate of None means
+# "copy when possible, otherwise encode at fallback_bitrate".
+OUTPUT_FORMATS = {
+    "mp3": {
+        "ext": "mp3",
+        "media_type": "audio/mpeg",
+        "muxer": "mp3",
+        "encoder": "libmp3lame",
+        "copy_acodecs": ("mp3",),
+        "source": "bestaudio",
+        "default_bitrate": "96k",
+        "fallback_bitrate": "96k",
+        "stream_args": [],
+    },
+    "m4a": {
+        "ext": "m4a",
+        "media_type": "audio/mp4",
+        "muxer": "ipod",
+        "encoder": "aac",
+        "copy_acodecs": ("mp4a", "aac"),
+        "source": "bestaudio[ext=m4a]/bestaudio",
+        "default_bitrate": None,
+        "fallback_bitrate": "128k",
+        # MP4 needs a seekable output unless it is fragmented. Files are
+        # fragmented too, since /download serves them while they're written
+        "stream_args": ["-movflags", "empty_moov+frag_keyframe+default_base_moof", "-frag_duration", "1000000"],
+    },
+    "opus": {
+        "ext": "webm",
+        "media_type": "audio/webm",
+        "muxer": "webm",
+        "encoder": "libopus",
+        "copy_acodecs": ("opus",),
+        "source": "bestaudio[acodec=opus]/bestaudio",
+        "default_bitrate": None,
+        "fallback_bitrate": "128k",
+        "stream_args": [],
+    },
+}
+
+BITRATE_PATTERN = r"^[1-9][0-9]{1,2}k$"
+# EBU R128 loudness normalization for "normalize" renditions
+LOUDNORM_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"
+
+_MEDIA_TYPES = {spec["ext"]: spec["media_type"] for spec in OUTPUT_FORMATS.values()}
+
+
+def media_type_for(filename):
+    return _MEDIA_TYPES.get(os.path.splitext(filename)[1].lstrip("."), "application/octet-stream")
+
+
+def requested_bitrate(output_format, bitrate):
+    """The bitrate a request asked for, or None if it leaves the choice to us."""
+    return bitrate or OUTPUT_FORMATS[output_format]["default_bitrate"]
+
+
+def source_selector(output_format, bitrate):
+    """yt-dlp format selector for the source of a conversion."""
+    return OUTPUT_FORMATS[output_format]["source"] if bitrate is None else "bestaudio"
+
+
+def can_copy(output_format, acodec):
+    """Whether audio in ``acodec`` can be remuxed into ``output_format`` without re-encoding."""
+    acodec = (acodec or "").lower()
+    return any(acodec.startswith(prefix) for prefix in OUTPUT_FORMATS[output_format]["copy_acodecs"])
+
+
+def rendition_name(output_format, bitrate, normalize=False):
+    """Short name for one output of a job, e.g. "mp3-192k" or "mp3-192k-norm"."""
+    return f"{output_format}-{bitrate or 'auto'}" + ("-norm" if normalize else "")
+
+
+def ffmpeg_output_args(output_format, bitrate, copy, normalize=False):
+    """ffmpeg arguments for one audio output, up to (not including) its target.
+
+    Every output can be read while ffmpeg is still writing it, whether it
+    goes to a pipe or to a file served progressively.
+    """
+    spec = OUTPUT_FORMATS[output_format]
+    if copy:
+        codec_args = ["-c:a", "copy"]
+    else:
+        filter_args = ["-af", LOUDNORM_FILTER] if normalize else []
+        codec_args = [*filter_args, "-c:a", spec["encoder"], "-b:a", bitrate or spec["fallback_bitrate"]]
+    return ["-vn", *codec_args, "-f", spec["muxer"], *spec["stream_args"]]
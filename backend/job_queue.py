@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Set to a file path to hand conversions to separate worker processes
+# (worker.py) instead of running them in the API process
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH")
+# A claimed job goes back to the queue if its worker stops renewing the lease this long
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+# Claims after which a job that keeps losing its worker is given up on
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+
+class JobQueue:
+    """Durable queue of conversion jobs waiting for a worker.
+
+    Payloads are JSON-serializable dicts. A worker ``claim``s a job, which
+    leases it for ``lease_seconds``; it must ``renew`` the lease while it
+    works and ``ack`` the job when it is finished. Jobs whose lease runs
+    out are handed to the next worker that asks, so a crashed worker
+    doesn't lose them. Methods are coroutines.
+    """
+
+    async def put(self, job_id, payload, client=None):
+        raise NotImplementedError
+
+    async def claim(self, worker_id):
+        """Lease the next job for ``worker_id`` and return (job_id, payload, attempts), or None."""
+        raise NotImplementedError
+
+    async def renew(self, job_id, worker_id):
+        """Extend the lease on a job. False if the worker no longer holds it."""
+        raise NotImplementedError
+
+    async def ack(self, job_id):
+        """Remove a finished job from the queue."""
+        raise NotImplementedError
+
+    async def depth(self, client=None):
+        """Number of jobs waiting to be claimed, in total or for one client."""
+        raise NotImplementedError
+
+    async def position(self, job_id):
+        """1-based place of a waiting job in the queue, or None once it is claimed."""
+        raise NotImplementedError
+
+
+class SqliteJobQueue(JobQueue):
+    """Job queue in a local SQLite file, shared by the API and worker processes that open it.
+
+    Jobs are claimed fairly between clients: the next job is the oldest
+    one of the client with the fewest jobs currently claimed. Like
+    SqliteJobStore, queries run on the queue's own thread.
+    """
+
+    def __init__(self, path, lease_seconds=JOB_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job_id TEXT UNIQUE NOT NULL,"
+            " client TEXT,"
+            " payload TEXT NOT NULL,"
+            " claimed_by TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS queue_lease ON queue (lease_until)")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _put(self, job_id, payload, client=None):
+        self._conn.execute(
+            "INSERT INTO queue (job_id, client, payload) VALUES (?, ?, ?)",
+            (job_id, client, json.dumps(payload)),
+        )
+
+    async def put(self, job_id, payload, client=None):
+        await self._run(self._put, job_id, payload, client)
+
+    def _claim(self, worker_id):
+        now = time.time()
+        # BEGIN IMMEDIATE so two workers can't claim the same job
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT q.job_id, q.payload, q.attempts FROM queue q"
+                " WHERE q.lease_until IS NULL OR q.lease_until < ?"
+                " ORDER BY (SELECT COUNT(*) FROM queue r WHERE r.client IS q.client AND r.lease_until >= ?), q.seq"
+                " LIMIT 1",
+                (now, now),
+            ).fetchone()
+            if row:
+                self._conn.execute(
+                    "UPDATE queue SET claimed_by = ?, lease_until = ?, attempts = attempts + 1 WHERE job_id = ?",
+                    (worker_id, now + self.lease_seconds, row[0]),
+                )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        job_id, payload, attempts = row
+        if attempts:
+            logger.warning(f"Job {job_id}: Lease expired, reclaimed by {worker_id} (attempt {attempts + 1}).")
+        return job_id, json.loads(payload), attempts + 1
+
+    async def claim(self, worker_id):
+        return await self._run(self._claim, worker_id)
+
+    def _renew(self, job_id, worker_id):
+        cursor = self._conn.execute(
+            "UPDATE queue SET lease_until = ? WHERE job_id = ? AND claimed_by = ?",
+            (time.time() + self.lease_seconds, job_id, worker_id),
+        )
+        return cursor.rowcount > 0
+
+    async def renew(self, job_id, worker_id):
+        return await self._run(self._renew, job_id, worker_id)
+
+    def _ack(self, job_id):
+        self._conn.execute("DELETE FROM queue WHERE job_id = ?", (job_id,))
+
+    async def ack(self, job_id):
+        await self._run(self._ack, job_id)
+
+    def _depth(self, client=None):
+        query = "SELECT COUNT(*) FROM queue WHERE (lease_until IS NULL OR lease_until < ?)"
+        args = (time.time(),)
+        if client is not None:
+            query += " AND client = ?"
+            args += (client,)
+        return self._conn.execute(query, args).fetchone()[0]
+
+    async def depth(self, client=None):
+        return await self._run(self._depth, client)
+
+    def _position(self, job_id):
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM queue WHERE (lease_until IS NULL OR lease_until < ?)"
+            " AND seq <= (SELECT seq FROM queue WHERE job_id = ? AND (lease_until IS NULL OR lease_until < ?))",
+            (now, job_id, now),
+        ).fetchone()
+        return row[0] or None
+
+    async def position(self, job_id):
+        return await self._run(self._position, job_id)
+
+
+def create_job_queue():
+    """The queue conversions go through, or None to run them in the API process."""
+    if JOB_QUEUE_PATH:
+        logger.info(f"Using SQLite job queue at {JOB_QUEUE_PATH}.")
+        return SqliteJobQueue(JOB_QUEUE_PATH)
+    return None
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Jobs are forgotten (and their files deleted) this long after their last update
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+# Upper bound on how many job records are kept at once
+MAX_JOBS = int(os.environ.get("MAX_JOBS", "10000"))
+# Set to a file path to share jobs between worker processes through SQLite
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH")
+
+FINISHED_STATUSES = ("done", "error")
+
+
+class JobStore:
+    """Where job records live.
+
+    Records are plain dicts. ``cache_key`` and ``status`` are understood by
+    the store so that in-flight jobs can be found by the output they are
+    producing; everything else is opaque.
+
+    Access methods are coroutines, so that a store backed by something
+    slower than memory doesn't block the event loop. Coroutines in this
+    process can ``subscribe`` to a job to be woken when it is created or
+    updated here. Updates made by other processes sharing the store are
+    not announced, so listeners should also re-check the store
+    periodically.
+    """
+
+    def __init__(self):
+        self._listeners = {}  # job_id -> set of asyncio.Event
+
+    def subscribe(self, job_id):
+        """Return an event that is set whenever ``job_id`` changes."""
+        event = asyncio.Event()
+        self._listeners.setdefault(job_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, job_id, event):
+        listeners = self._listeners.get(job_id)
+        if listeners:
+            listeners.discard(event)
+            if not listeners:
+                del self._listeners[job_id]
+
+    def _notify(self, job_id):
+        for event in self._listeners.get(job_id, ()):
+            event.set()
+
+    async def create(self, job_id, record):
+        raise NotImplementedError
+
+    async def get(self, job_id):
+        raise NotImplementedError
+
+    async def update(self, job_id, **fields):
+        raise NotImplementedError
+
+    async def add(self, job_id, field, amount):
+        """Atomically add ``amount`` to a numeric field (0 if unset); returns the new value, or None."""
+        raise NotImplementedError
+
+    async def find_active(self, cache_key):
+        """Return the ID of an unfinished job producing ``cache_key``, or None."""
+        raise NotImplementedError
+
+    async def find_or_create(self, job_id, record):
+        """Atomically ``find_active`` for the record's cache_key, or else ``create`` it.
+
+        Returns the unfinished job's ID, or None if ``record`` was created.
+        """
+        raise NotImplementedError
+
+    async def sweep(self, now=None):
+        """Drop expired and over-capacity jobs and return the removed records.
+
+        Over capacity, only finished jobs are dropped; a running job's
+        record is needed until it finishes.
+        """
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Per-process job store with TTL expiry and a cap on the number of jobs."""
+
+    def __init__(self, ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        super().__init__()
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()  # job_id -> record, least recently updated first
+        self._dropped = []
+
+    async def create(self, job_id, record):
+        record = dict(record, updated_at=time.time())
+        record.setdefault("created_at", record["updated_at"])
+        self._jobs[job_id] = record
+        self._jobs.move_to_end(job_id)
+        excess = len(self._jobs) - self.max_jobs
+        if excess > 0:
+            finished = [other_id for other_id, other in self._jobs.items() if other.get("status") in FINISHED_STATUSES]
+            for dropped_id in finished[:excess]:
+                self._dropped.append(self._jobs.pop(dropped_id))
+        self._notify(job_id)
+
+    async def get(self, job_id):
+        record = self._jobs.get(job_id)
+        return dict(record) if record is not None else None
+
+    async def update(self, job_id, **fields):
+        record = self._jobs.get(job_id)
+        if record is None:
+            return
+        record.update(fields, updated_at=time.time())
+        self._jobs.move_to_end(job_id)
+        self._notify(job_id)
+
+    async def add(self, job_id, field, amount):
+        record = self._jobs.get(job_id)
+        if record is None:
+            return None
+        await self.update(job_id, **{field: record.get(field, 0) + amount})
+        return record[field]
+
+    async def find_active(self, cache_key):
+        cutoff = time.time() - self.ttl
+        for job_id, record in reversed(self._jobs.items()):
+            if record["updated_at"] < cutoff:
+                break
+            if record.get("cache_key") == cache_key and record.get("status") not in FINISHED_STATUSES:
+                return job_id
+        return None
+
+    async def find_or_create(self, job_id, record):
+        # Neither call awaits anything, so nothing can run in between
+        existing = await self.find_active(record["cache_key"])
+        if existing is None:
+            await self.create(job_id, record)
+        return existing
+
+    async def sweep(self, now=None):
+        cutoff = (now or time.time()) - self.ttl
+        removed, self._dropped = self._dropped, []
+        while self._jobs:
+            job_id, record = next(iter(self._jobs.items()))
+            if record["updated_at"] >= cutoff:
+                break
+            del self._jobs[job_id]
+            removed.append(record)
+        return removed
+
+
+class SqliteJobStore(JobStore):
+    """Job store in a local SQLite file, shared by every process that opens it.
+
+    Queries run one at a time on the store's own thread: waiting for
+    another process's write lock then holds up other store calls, but
+    not the event loop.
+    """
+
+    def __init__(self, path, ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY,"
+            " cache_key TEXT,"
+            " status TEXT,"
+            " updated_at REAL NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key, status)")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _write(self, job_id, record):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, cache_key, status, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+            (job_id, record.get("cache_key"), record.get("status"), record["updated_at"], json.dumps(record)),
+        )
+
+    async def create(self, job_id, record):
+        record = dict(record, updated_at=time.time())
+        record.setdefault("created_at", record["updated_at"])
+        await self._run(self._write, job_id, record)
+        self._notify(job_id)
+
+    def _get(self, job_id):
+        row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get(self, job_id):
+        return await self._run(self._get, job_id)
+
+    def _update(self, job_id, fields):
+        # BEGIN IMMEDIATE so read-modify-write is atomic across processes
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row:
+                record = json.loads(row[0])
+                record.update(fields, updated_at=time.time())
+                self._write(job_id, record)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    async def update(self, job_id, **fields):
+        await self._run(self._update, job_id, fields)
+        self._notify(job_id)
+
+    def _add(self, job_id, field, amount):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            value = None
+            if row:
+                record = json.loads(row[0])
+                value = record[field] = record.get(field, 0) + amount
+                record["updated_at"] = time.time()
+                self._write(job_id, record)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return value
+
+    async def add(self, job_id, field, amount):
+        value = await self._run(self._add, job_id, field, amount)
+        self._notify(job_id)
+        return value
+
+    def _find_active(self, cache_key):
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        row = self._conn.execute(
+            f"SELECT job_id FROM jobs WHERE cache_key = ? AND status NOT IN ({placeholders})"
+            " AND updated_at >= ? ORDER BY updated_at DESC LIMIT 1",
+            (cache_key, *FINISHED_STATUSES, time.time() - self.ttl),
+        ).fetchone()
+        return row[0] if row else None
+
+    async def find_active(self, cache_key):
+        return await self._run(self._find_active, cache_key)
+
+    def _find_or_create(self, job_id, record):
+        # BEGIN IMMEDIATE so two processes can't both miss and create
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            existing = self._find_active(record["cache_key"])
+            if existing is None:
+                self._write(job_id, record)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return existing
+
+    async def find_or_create(self, job_id, record):
+        record = dict(record, updated_at=time.time())
+        record.setdefault("created_at", record["updated_at"])
+        existing = await self._run(self._find_or_create, job_id, record)
+        if existing is None:
+            self._notify(job_id)
+        return existing
+
+    def _sweep(self, cutoff):
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Over capacity, the oldest finished jobs go; unfinished ones stay
+            unfinished = self._conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE status NOT IN ({placeholders})", FINISHED_STATUSES,
+            ).fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT job_id, data FROM jobs WHERE updated_at < ?"
+                f" OR (status IN ({placeholders}) AND job_id NOT IN"
+                f" (SELECT job_id FROM jobs WHERE status IN ({placeholders}) ORDER BY updated_at DESC LIMIT ?))",
+                (cutoff, *FINISHED_STATUSES, *FINISHED_STATUSES, max(0, self.max_jobs - unfinished)),
+            ).fetchall()
+            self._conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id, _ in rows])
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return [json.loads(data) for _, data in rows]
+
+    async def sweep(self, now=None):
+        return await self._run(self._sweep, (now or time.time()) - self.ttl)
+
+
+def create_job_store():
+    """Pick the job store backend from the environment."""
+    if JOB_STORE_PATH:
+        logger.info(f"Using SQLite job store at {JOB_STORE_PATH}.")
+        return SqliteJobStore(JOB_STORE_PATH)
+    return MemoryJobStore()
@@ -1,19 +1,30 @@
-from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi import FastAPI, Query, Request, Response, WebSocket, WebSocketDisconnect, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
 import asyncio
-from asyncio import Semaphore
+import json
 import os
+import re
 import uuid
 import logging
 import time
-import random
-import requests
 from bs4 import BeautifulSoup
-
-# Path to your exported cookies file (Netscape format)
-COOKIES_FILE = "cookies.txt"
+from cache import extract_video_id
+from conversion import (
+    WORK_DIR, cancel_conversion, conversion_cache, convert_youtube_to_mp3, describe_output, job_store, metadata_cache,
+    plan_outputs, proxy_pool, refresh_proxies, scheduler, scheduler_stages,
+)
+from formats import BITRATE_PATTERN, OUTPUT_FORMATS, ffmpeg_output_args, media_type_for
+from downloader import RANGE_MAX_CONNECTIONS
+from job_queue import create_job_queue
+from job_store import FINISHED_STATUSES
+from metrics import BYTES_RELAYED, JOB_OUTCOMES, QUEUE_WAIT, SPAWN_LATENCY
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from scheduler import MAX_QUEUE, MAX_QUEUE_PER_CLIENT, QueueFull
+from streaming import FOLLOW_CHUNK_SIZE, FOLLOW_POLL_INTERVAL, GrowingFile, file_response, follow_file, zip_files
+from supervisor import supervisor
 
 app = FastAPI()
 app.add_middleware(
@@ -30,60 +41,341 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-conversion_jobs = {}
+# Job records are expired by the sweeper started in startup_event
+JOB_SWEEP_INTERVAL = 60  # seconds
+JOB_WATCH_POLL_INTERVAL = 1.0  # seconds; catches updates made by other processes
+JOB_WATCH_KEEPALIVE = 15.0  # seconds between SSE keepalive comments
+
+# With JOB_QUEUE_PATH set, conversions are left to worker.py processes
+job_queue = create_job_queue()
+
+# Set when running behind a reverse proxy, so clients are told apart by X-Forwarded-For
+TRUST_FORWARDED_FOR = os.environ.get("TRUST_FORWARDED_FOR", "") == "1"
+
+def client_id(request):
+    """Identify the client for fair queuing."""
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+def queue_full_response(e):
+    return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "30"})
 
 async def run_subprocess(*args):
     """Run a subprocess asynchronously and capture stdout/stderr."""
     logger.info(f"Running subprocess: {' '.join(args)}")
     
-    # Add proxy if it's a yt-dlp call
+    # Add proxy if it's a yt-dlp call that doesn't already have one
+    proxy = None
     if args and 'yt-dlp' in args[0]:
-        proxy = get_random_proxy()
-        if proxy:
-            args = list(args) + ['--proxy', proxy]
-            logger.info(f"Added proxy {proxy} to yt-dlp command.")
+        if '--proxy' in args:
+            proxy = args[args.index('--proxy') + 1]
+        else:
+            proxy = proxy_pool.pick()
+            if proxy:
+                args = list(args) + ['--proxy', proxy]
+                logger.info(f"Added proxy {proxy} to yt-dlp command.")
     
-    process = await asyncio.create_subprocess_exec(
+    process = await supervisor.spawn(
         *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
-    stdout, stderr = await process.communicate()
+    try:
+        stdout_task = asyncio.create_task(process.stdout.read())
+        stderr = await process.read_stderr()
+        stdout = await stdout_task
+        await process.wait()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
     
     # Log stderr
     if stderr:
-        logger.warning(f"Subprocess stderr: {stderr.decode().strip()}")
+        logger.warning(f"Subprocess stderr: {stderr}")
     
     if process.returncode != 0:
-        logger.error(f"Subprocess failed: {stderr.decode().strip()}")
-        raise Exception(f"Command failed: {stderr.decode().strip()}")
-    
+        if proxy:
+            proxy_pool.report_failure(proxy)
+        logger.error(f"Subprocess failed: {process.error or stderr}")
+        raise Exception(f"Command failed: {process.error or stderr}")
+
+    if proxy:
+        proxy_pool.report_success(proxy)
     logger.info(f"Subprocess output: {stdout.decode().strip()}")
     return stdout.decode().strip()
 
+OutputFormat = Literal[tuple(OUTPUT_FORMATS)]
+MAX_RENDITIONS = 6
+
+class RenditionRequest(BaseModel):
+    format: OutputFormat = "mp3"
+    bitrate: Optional[str] = Field(None, pattern=BITRATE_PATTERN)
+    normalize: bool = False
+
 class ConversionRequest(BaseModel):
     youtube_url: str
+    format: OutputFormat = "mp3"
+    # Leave unset to remux the source audio without re-encoding when possible
+    bitrate: Optional[str] = Field(None, pattern=BITRATE_PATTERN)
+    # Several outputs from one download and one ffmpeg pass; replaces format/bitrate
+    renditions: Optional[List[RenditionRequest]] = Field(None, min_length=1, max_length=MAX_RENDITIONS)
+    # Parallel connections for DOWNLOADER=ranged, instead of the proxy's setting
+    download_connections: Optional[int] = Field(None, ge=1, le=RANGE_MAX_CONNECTIONS)
+
+async def check_queue_capacity(client):
+    """Admission control for the job queue, with the scheduler's limits."""
+    if await job_queue.depth() >= MAX_QUEUE:
+        raise QueueFull("Server is busy, please try again later")
+    if await job_queue.depth(client) >= MAX_QUEUE_PER_CLIENT:
+        raise QueueFull(f"Too many queued jobs (limit {MAX_QUEUE_PER_CLIENT})")
+
+async def submit_conversion(youtube_url, job_id, outputs, client, with_renditions=False, download=None):
+    """Create job ``job_id`` producing ``outputs``, unless it can be answered another way.
+
+    Returns ``job_id``, which is an alias of an in-flight job when one
+    already produces the same outputs, and the outputs that still have
+    to be converted with ``convert_youtube_to_mp3`` here (None when there
+    is nothing to run, or when a worker will pick it up from the job
+    queue). Raises QueueFull when the backlog is too long.
+    """
+    key = "+".join(o["cache_key"] for o in outputs)
+
+    # Serve repeat videos straight from the cache
+    renditions = {}
+    cached_paths = {}
+    for output in outputs:
+        cached_path = conversion_cache.lookup(output["cache_key"], output["ext"])
+        cached_paths[output["name"]] = cached_path
+        renditions[output["name"]] = {
+            "format": output["format"], "bitrate": output["bitrate"], "normalize": output["normalize"],
+            "download_url": f"/download/{os.path.basename(cached_path)}" if cached_path else None,
+        }
+    primary = renditions[outputs[0]["name"]]
+    if all(r["download_url"] for r in renditions.values()):
+        logger.info(f"Job {job_id}: Cache hit for {key}.")
+        JOB_OUTCOMES.labels("cached").inc()
+        await job_store.create(job_id, {
+            "status": "done", "progress": 100, "error": None, "cached": True,
+            "download_url": primary["download_url"], "file_path": cached_paths[outputs[0]["name"]],
+            **({"renditions": renditions} if with_renditions else {}),
+        })
+        return job_id, None
+
+    # Only the outputs that aren't cached yet need converting
+    missing = [o for o in outputs if not renditions[o["name"]]["download_url"]]
+    for output in missing:
+        output["file_path"] = os.path.join(WORK_DIR, output["filename"])
+        # Streams the file while it is still being converted
+        renditions[output["name"]]["progressive_url"] = f"/download/{output['filename']}"
+    record = {
+        "status": "queued", "progress": 0, "download_url": primary["download_url"], "error": None,
+        "cache_key": key, "requesters": 1, "format": outputs[0]["format"], "bitrate": outputs[0]["bitrate"],
+        "progressive_url": primary.get("progressive_url"),
+        "file_path": outputs[0].get("file_path", cached_paths[outputs[0]["name"]]),
+        "file_paths": {o["filename"]: o["file_path"] for o in missing},
+        **({"renditions": renditions} if with_renditions else {}),
+    }
+
+    # Reject new work once the backlog is too long, then create the job
+    # unless the same video is already converting: in one step, so that
+    # concurrent requests for it can't each start their own conversion
+    try:
+        if job_queue:
+            await check_queue_capacity(client)
+        else:
+            scheduler.admit(job_id, client, scheduler_stages(outputs))
+    except QueueFull:
+        # Attaching adds no work, so it is still allowed
+        inflight_job_id = await job_store.find_active(key)
+        if not inflight_job_id:
+            JOB_OUTCOMES.labels("rejected").inc()
+            raise
+    else:
+        inflight_job_id = await job_store.find_or_create(job_id, record)
+        if inflight_job_id and not job_queue:
+            scheduler.withdraw(job_id)
+
+    # Attach to the conversion that is already running. The request keeps
+    # its own job ID, as an alias of the shared job, so that it can be
+    # cancelled without cancelling the others.
+    if inflight_job_id:
+        logger.info(f"Job {job_id}: Attached to in-flight job {inflight_job_id} for {key}.")
+        JOB_OUTCOMES.labels("attached").inc()
+        await job_store.add(inflight_job_id, "requesters", 1)
+        await job_store.create(job_id, {"alias_of": inflight_job_id})
+        return job_id, None
+
+    if job_queue:
+        await job_queue.put(job_id, {"youtube_url": youtube_url, "outputs": missing, "download": download}, client)
+        logger.info(f"Job {job_id}: Handed to the job queue.")
+        return job_id, None
+    return job_id, missing
 
 @app.post("/start_conversion")
-async def start_conversion(request: ConversionRequest, background_tasks: BackgroundTasks):
+async def start_conversion(request: ConversionRequest, background_tasks: BackgroundTasks, http_request: Request):
     try:
         job_id = str(uuid.uuid4())
         logger.info(f"Job {job_id}: Received conversion request for URL: {request.youtube_url}")
-        conversion_jobs[job_id] = {"status": "initializing", "progress": 0, "download_url": None, "error": None}
+        if request.renditions:
+            outputs = [describe_output(request.youtube_url, r.format, r.bitrate, r.normalize) for r in request.renditions]
+            # Renditions are downloaded as {job_id}.{name}.{ext}
+            outputs = list({o["name"]: dict(o, filename=f"{job_id}.{o['name']}.{o['ext']}") for o in outputs}.values())
+        else:
+            output = describe_output(request.youtube_url, request.format, request.bitrate)
+            outputs = [dict(output, filename=f"{job_id}.{output['ext']}")]
+
+        download = {"connections": request.download_connections} if request.download_connections else None
+        try:
+            job_id, missing = await submit_conversion(
+                request.youtube_url, job_id, outputs, client_id(http_request),
+                with_renditions=bool(request.renditions), download=download,
+            )
+        except QueueFull as e:
+            logger.warning(f"Job {job_id}: Rejected: {str(e)}")
+            return queue_full_response(e)
 
-        background_tasks.add_task(convert_youtube_to_mp3, request.youtube_url, job_id)
-        logger.info(f"Job {job_id}: Conversion task added to background.")
+        if missing:
+            background_tasks.add_task(convert_youtube_to_mp3, request.youtube_url, job_id, missing, download)
+            logger.info(f"Job {job_id}: Conversion task added to background.")
         return {"job_id": job_id}
     except Exception as e:
         logger.error(f"Error in /start_conversion: {str(e)}")
         return {"error": str(e)}
 
+async def resolve_job(job_id):
+    """Return the ID and record of the job ``job_id`` refers to, and ``job_id``'s own record.
+
+    They differ for a request that attached to a running conversion: its
+    job ID is an alias of the shared job. Records are None if not found.
+    """
+    handle = await job_store.get(job_id)
+    if handle and handle.get("alias_of"):
+        shared_id = handle["alias_of"]
+        return shared_id, await job_store.get(shared_id), handle
+    return job_id, handle, handle
+
+async def public_job(job_id, job, handle=None):
+    """The parts of a job record that are safe to show to clients, plus its queue position.
+
+    ``handle`` is the record of the requester asking (see ``resolve_job``),
+    if not ``job`` itself.
+    """
+    handle = handle or job
+    job = dict(job)
+    job.pop("file_path", None)
+    job.pop("file_paths", None)
+    job.pop("requesters", None)
+    job.pop("cancel_requests", None)
+    if handle.get("cancel_requests") and job.get("status") not in FINISHED_STATUSES:
+        # This requester cancelled; the conversion goes on for the others
+        return dict(job, status="error", error="Cancelled", detached=True)
+    if job.get("status") == "queued":
+        if job_queue:
+            position = await job_queue.position(job_id)
+            job.update({"queue_position": position} if position else {})
+        else:
+            job.update(scheduler.status(job_id) or {})
+    return job
+
 @app.get("/job_status/{job_id}")
 async def job_status(job_id: str):
-    job = conversion_jobs.get(job_id)
+    shared_id, job, handle = await resolve_job(job_id)
     if not job:
         return {"error": "Job not found"}
-    return job
+    return await public_job(shared_id, job, handle)
+
+@app.post("/cancel_job/{job_id}")
+async def cancel_job(job_id: str):
+    """Stop a queued or running conversion, killing its processes.
+
+    Requests for a video that was already converting share its job, each
+    through its own job ID (see ``resolve_job``), so the conversion is only
+    stopped once every requester has cancelled. Until then a cancel just
+    detaches the requester; cancelling the same job ID again changes nothing.
+    """
+    shared_id, job, handle = await resolve_job(job_id)
+    if not job:
+        return {"error": "Job not found"}
+    if "items" in job:
+        return {"error": "Batches can't be cancelled"}
+    if job.get("status") not in FINISHED_STATUSES and await job_store.add(job_id, "cancel_requests", 1) == 1:
+        remaining = await job_store.add(shared_id, "requesters", -1)
+        if remaining is not None and remaining > 0:
+            logger.info(f"Job {shared_id}: Requester {job_id} detached; {remaining} still waiting on it.")
+        else:
+            # Workers in other processes see the flag in the job store
+            await job_store.update(shared_id, status="error", error="Cancelled", cancelled=True)
+            cancel_conversion(shared_id)
+            JOB_OUTCOMES.labels("cancelled").inc()
+            logger.info(f"Job {shared_id}: Cancelled by request.")
+    shared_id, job, handle = await resolve_job(job_id)
+    return await public_job(shared_id, job, handle)
+
+async def watch_job(job_id, keepalive=None):
+    """Yield a job's public record every time it changes, until it finishes.
+
+    Local updates wake the watcher immediately; the store is also re-read
+    every JOB_WATCH_POLL_INTERVAL for updates made by other processes. If
+    ``keepalive`` is set, None is yielded after that many idle seconds.
+    """
+    shared_id = (await resolve_job(job_id))[0]
+    event = job_store.subscribe(shared_id)
+    try:
+        last_sent = None
+        idle = 0.0
+        while True:
+            event.clear()
+            shared_id, job, handle = await resolve_job(job_id)
+            if not job:
+                yield {"error": "Job not found"}
+                return
+            job = await public_job(shared_id, job, handle)
+            # Compare whole records, since queue position changes without a
+            # store update, but not the estimates, which drift every second
+            snapshot = {k: v for k, v in job.items() if not k.startswith("estimated_")}
+            if snapshot != last_sent:
+                last_sent = snapshot
+                idle = 0.0
+                yield job
+                if job.get("status") in FINISHED_STATUSES:
+                    return
+            elif keepalive and idle >= keepalive:
+                idle = 0.0
+                yield None
+            try:
+                await asyncio.wait_for(event.wait(), timeout=JOB_WATCH_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                idle += JOB_WATCH_POLL_INTERVAL
+    finally:
+        job_store.unsubscribe(shared_id, event)
+
+@app.get("/job_events/{job_id}")
+async def job_events(job_id: str):
+    """Server-Sent Events stream of job status updates."""
+    async def event_stream():
+        async for job in watch_job(job_id, keepalive=JOB_WATCH_KEEPALIVE):
+            if job is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {json.dumps(job)}\n\n"
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+@app.websocket("/ws/job_status/{job_id}")
+async def job_status_ws(websocket: WebSocket, job_id: str):
+    """WebSocket stream of job status updates; closed once the job finishes."""
+    await websocket.accept()
+    try:
+        async for job in watch_job(job_id):
+            await websocket.send_json(job)
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -168,30 +460,51 @@ async def root():
                     const data = await res.json();
                     const jobId = data.job_id;
 
-                    // Poll for status and show download button
-                    const statusInterval = setInterval(async () => {
-                        const statusRes = await fetch(`/job_status/${jobId}`);
-                        const statusData = await statusRes.json();
+                    // Returns true once the job has finished
+                    const showStatus = (statusData) => {
                         if (statusData.status === 'done') {
-                            clearInterval(statusInterval);
                             spinner.style.display = 'none';
                             const link = document.createElement('a');
-                            link.href = `/download/${jobId}.mp3`;
+                            link.href = statusData.download_url;
                             link.className = 'download-btn';
                             link.textContent = 'Download MP3';
                             resultDiv.innerHTML = '<div>Conversion complete:</div>';
                             resultDiv.appendChild(link);
-                        } else if (statusData.status === 'error') {
-                            clearInterval(statusInterval);
+                            return true;
+                        } else if (statusData.status === 'error' || statusData.error) {
                             spinner.style.display = 'none';
                             resultDiv.textContent = `Error: ${statusData.error}`;
+                            return true;
+                        }
+                        resultDiv.textContent = `Converting... ${statusData.progress || 0}%`;
+                        return false;
+                    };
+
+                    // Status updates are pushed by the server; poll only if that fails
+                    const events = new EventSource(`/job_events/${jobId}`);
+                    events.onmessage = (e) => {
+                        if (showStatus(JSON.parse(e.data))) {
+                            events.close();
                         }
-                    }, 1000); // Check status every 1 second
+                    };
+                    events.onerror = () => {
+                        events.close();
+                        pollStatus(jobId, showStatus);
+                    };
                 } catch (err) {
                     spinner.style.display = 'none';
                     resultDiv.textContent = `Error: ${err.message}`;
                 }
             }
+
+            function pollStatus(jobId, showStatus) {
+                const statusInterval = setInterval(async () => {
+                    const statusRes = await fetch(`/job_status/${jobId}`);
+                    if (showStatus(await statusRes.json())) {
+                        clearInterval(statusInterval);
+                    }
+                }, 1000); // Check status every 1 second
+            }
         </script>
     </body>
     </html>
@@ -201,260 +514,354 @@ async def root():
 @app.get("/getVideoUrl")
 async def get_video_url(youtube_url: str = Query(...), fmt: str = "bestaudio"):
     try:
-        # Get audio URL and title
-        audio_url = await run_subprocess(
-            "yt-dlp", "-f", fmt, "-g", "--cookies", COOKIES_FILE, youtube_url
-        )
-        title = await run_subprocess(
-            "yt-dlp", "--get-title", "--cookies", COOKIES_FILE, youtube_url
-        )
+        # Get audio URL, title and formats from one (cached) extraction
+        info = await metadata_cache.extract(youtube_url, fmt)
 
         # Return info only (no MP3 conversion)
-        return {"title": title, "audioUrl": audio_url}
+        return {"title": info["title"], "audioUrl": info["url"], "duration": info["duration"], "formats": info["formats"]}
     except Exception as e:
         return {"error": str(e)}
 
-@app.get("/download/{mp3_filename}")
-async def download_mp3(mp3_filename: str):
-    mp3_filepath = f"/tmp/{mp3_filename}"
-    if os.path.exists(mp3_filepath):
-        return FileResponse(mp3_filepath, media_type="audio/mpeg", filename=mp3_filename)
-    return {"error": "File not found"}
+def job_file_waiter(job_id):
+    """``wait_for_more`` for ``follow_file`` on the output of a running job."""
+    async def wait_for_more():
+        job = await job_store.get(job_id)
+        if not job or job.get("status") == "error":
+            raise RuntimeError(f"Job {job_id} failed: {job.get('error') if job else 'job expired'}")
+        if job.get("status") == "done":
+            return False
+        await asyncio.sleep(FOLLOW_POLL_INTERVAL)
+        return True
+
+    return wait_for_more
+
+@app.api_route("/download/{mp3_filename}", methods=["GET", "HEAD"])
+async def download_mp3(mp3_filename: str, request: Request):
+    mp3_filename = os.path.basename(mp3_filename)
+
+    # Cached conversions
+    media_type = media_type_for(mp3_filename)
+    mp3_filepath = os.path.join(conversion_cache.directory, mp3_filename)
+    if os.path.isfile(mp3_filepath):
+        return file_response(request, mp3_filepath, media_type, mp3_filename)
+
+    # Jobs, by /download/{job_id}.mp3
+    requested_id = mp3_filename.split(".", 1)[0]
+    # and renditions by /download/{job_id}.{rendition}.{ext}
+    job_id, job, _ = await resolve_job(requested_id)
+    # An attached request's job ID names the shared job's files
+    mp3_filename = job_id + mp3_filename[len(requested_id):]
+    file_path = job and (job.get("file_paths") or {}).get(mp3_filename, job.get("file_path"))
+    if not file_path or job.get("status") == "error":
+        return {"error": "File not found"}
+    if job.get("status") == "done":
+        return file_response(request, file_path, media_type, mp3_filename)
+
+    # Still converting: send the file as ffmpeg writes it
+    wait_for_more = job_file_waiter(job_id)
+    while not os.path.exists(file_path):
+        try:
+            more = await wait_for_more()
+        except RuntimeError:
+            # Failed or expired before ffmpeg created the file
+            return {"error": "File not found"}
+        if not more:
+            # Finished (and moved into the cache) while we waited
+            job = await job_store.get(job_id)
+            file_path = job and (job.get("file_paths") or {}).get(mp3_filename, job.get("file_path"))
+            if not file_path:
+                return {"error": "File not found"}
+            return file_response(request, file_path, media_type, mp3_filename)
+    headers = {"Content-Disposition": f'attachment; filename="{mp3_filename}"'}
+    if request.method == "HEAD":
+        # The length isn't known until the conversion is done
+        return StreamingResponse(iter(()), media_type=media_type, headers=headers)
+    return StreamingResponse(follow_file(file_path, wait_for_more), media_type=media_type, headers=headers)
+
+# Cache key -> GrowingFile for /stream_conversion transcodes in progress
+active_streams = {}
+STREAM_READ_TIMEOUT = 10.0  # seconds without ffmpeg output before it is killed
+
+async def transcode_stream(key, growing, stream_url, output_format, plan):
+    """Convert ``stream_url`` as planned by ``plan_outputs``, appending the output to ``growing``."""
+    # No -re: transcode as fast as the input arrives, not at playback speed
+    ffmpeg_command = [
+        "ffmpeg",
+        "-i", stream_url,    # Input is the YouTube stream URL
+        *ffmpeg_output_args(output_format, plan["bitrate"], plan["copy"], normalize=plan["normalize"]),
+        "-flush_packets", "1",  # Flush packets immediately so followers see them
+        "pipe:1"             # Output to stdout (streaming)
+    ]
+    spawn_start = time.time()
+    process = await supervisor.spawn(
+        *ffmpeg_command,
+        stage="encode",
+        idle_timeout=STREAM_READ_TIMEOUT,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    SPAWN_LATENCY.labels("stream").observe(time.time() - spawn_start)
+    logger.info(f"FFmpeg process started for stream {key}")
+    stderr_task = asyncio.create_task(process.read_stderr())
+
+    try:
+        with open(growing.path, "ab") as f:
+            while True:
+                chunk = await process.stdout.read(FOLLOW_CHUNK_SIZE)
+                if not chunk:
+                    break
+                process.touch()
+                f.write(chunk)
+                f.flush()
+                growing.advance(len(chunk))
+                BYTES_RELAYED.labels("stream").inc(len(chunk))
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        await process.wait()
+        stderr = await stderr_task
+        if stderr:
+            logger.info(f"FFmpeg stderr: {stderr}")
+
+    if process.returncode != 0:
+        raise Exception(process.error or f"ffmpeg failed: {stderr or 'Unknown error'}")
+    logger.info(f"Streaming complete for {key}. Total bytes: {growing.size}")
+
+async def produce_stream(stream_id, key, growing, stream_url, output_format, plan):
+    """Run ``transcode_stream`` when the scheduler allows, then move the file into the cache."""
+    try:
+        async with scheduler.run(stream_id) as queue_wait:
+            QUEUE_WAIT.labels("stream").observe(queue_wait)
+            await transcode_stream(key, growing, stream_url, output_format, plan)
+        # Move and repoint in one step, so no new follower opens the old path
+        cached_path = conversion_cache.place(growing.path, key, OUTPUT_FORMATS[output_format]["ext"])
+        growing.finish(cached_path)
+    except BaseException as e:
+        logger.error(f"Stream conversion failed for {key}: {str(e) or type(e).__name__}")
+        growing.fail(str(e) or type(e).__name__)
+        try:
+            os.remove(growing.path)
+        except FileNotFoundError:
+            pass
+        if not isinstance(e, Exception):
+            raise
+    finally:
+        if active_streams.get(key) is growing:
+            del active_streams[key]
+    if growing.error is None:
+        await asyncio.to_thread(conversion_cache.evict, keep=cached_path)
 
 @app.get("/stream_conversion")
-async def stream_conversion(youtube_url: str):
+async def stream_conversion(
+    youtube_url: str,
+    request: Request,
+    output_format: OutputFormat = Query("mp3", alias="format"),
+    bitrate: Optional[str] = Query(None, pattern=BITRATE_PATTERN),
+):
     try:
         logger.info(f"Starting stream conversion for URL: {youtube_url}")
-
-        # Get a random proxy
-        proxy = get_random_proxy()
-        proxy_flag = ['--proxy', proxy] if proxy else []
-        logger.info(f"Using proxy {proxy} for streaming.")
-
-        # Step 1: Get the YouTube stream URL
-        stream_url = await run_subprocess(
-            "yt-dlp", "-f", "bestaudio", "--no-playlist", "-g", "--cookies", COOKIES_FILE, youtube_url,
-            *proxy_flag  # Add proxy flag
-        )
-        logger.info(f"Stream URL obtained: {stream_url}")
-
-        # Step 2: Use ffmpeg to process the stream and convert it to MP3
-        ffmpeg_command = [
-            "ffmpeg",
-            "-re",               # Read input in real-time
-            "-fflags", "nobuffer",  # Minimize buffering
-            "-i", stream_url,    # Input is the YouTube stream URL
-            "-f", "mp3",         # Output format is MP3
-            "-b:a", "96k",       # Lower audio bitrate for faster conversion
-            "-vn",               # No video
-            "-preset", "ultrafast",  # Use the fastest encoding preset
-            "-threads", "8",     # Use 4 threads
-            "-flush_packets", "1",  # Flush packets immediately
-            "pipe:1"             # Output to stdout (streaming)
-        ]
-
-        process = await asyncio.create_subprocess_exec(
-            *ffmpeg_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        logger.info("FFmpeg process started")
-
-        # Step 3: Stream the MP3 output to the user's browser
-        async def mp3_stream():
-            try:
-                total_bytes = 0
-                chunk_size = 1048576  # 1 MB chunks (increased for speed)
-                while True:
-                    chunk = await asyncio.wait_for(process.stdout.read(chunk_size), timeout=10.0)  # 10-second timeout
-                    if not chunk:
-                        break
-                    total_bytes += len(chunk)
-                    yield chunk
-                logger.info(f"Streaming complete. Total bytes: {total_bytes}")
-            except asyncio.TimeoutError:
-                logger.error("Streaming timed out")
-                raise
-            except Exception as e:
-                logger.error(f"Error during streaming: {str(e)}")
-                raise
-            finally:
-                stderr = await process.stderr.read()
-                logger.info(f"FFmpeg stderr: {stderr.decode().strip()}")
+        spec = OUTPUT_FORMATS[output_format]
+        output = describe_output(youtube_url, output_format, bitrate)
+        key = output["cache_key"]
 
         # Set the response headers to trigger a download in the browser
+        filename = f"converted.{spec['ext']}"
         headers = {
-            "Content-Disposition": 'attachment; filename="converted.mp3"',
-            "Content-Type": "audio/mpeg",
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Content-Type": spec["media_type"],
         }
 
-        return StreamingResponse(mp3_stream(), headers=headers)
+        # Finished before: serve the cached file
+        cached_path = conversion_cache.lookup(key, spec["ext"])
+        if cached_path:
+            logger.info(f"Serving stream for {key} from cache.")
+            return file_response(request, cached_path, spec["media_type"], filename)
+
+        # Not being transcoded yet: start writing it to a file that every
+        # client for this video reads from as it grows
+        growing = active_streams.get(key)
+        if growing is None:
+            # Step 1: Get the YouTube stream URL, preferring one we can remux
+            planned = await plan_outputs(youtube_url, [output])
+            stream_url = (planned["info"] or await metadata_cache.extract(youtube_url, planned["selector"]))["url"]
+            plan = planned["outputs"][0]
+            logger.info(f"Stream URL obtained ({'remux' if plan['copy'] else 'transcode'}): {stream_url}")
+
+            # Another request may have started it while we were extracting
+            growing = active_streams.get(key)
+            if growing is None:
+                stream_id = f"stream-{uuid.uuid4()}"
+                try:
+                    scheduler.admit(stream_id, client_id(request), ("download",) if plan["copy"] else ("download", "encode"))
+                except QueueFull as e:
+                    logger.warning(f"Stream for {key} rejected: {str(e)}")
+                    return queue_full_response(e)
+                growing = GrowingFile(f"/tmp/{stream_id}.{spec['ext']}")
+                open(growing.path, "wb").close()
+                active_streams[key] = growing
+                growing.task = asyncio.create_task(produce_stream(stream_id, key, growing, stream_url, output_format, plan))
+        else:
+            logger.info(f"Following in-progress stream for {key}.")
+
+        # Step 2: Stream the output to the user's browser as it is written
+        return StreamingResponse(growing.follow(), headers=headers)
 
     except Exception as e:
         logger.error(f"Stream conversion failed: {str(e)}")
         return {"error": str(e)}
 
-# Add a semaphore to limit concurrent conversions (e.g., 2 at a time)
-conversion_semaphore = Semaphore(2)
-
-# Function to test a proxy (keep timeout at 5 seconds, no retries)
-def test_proxy(proxy):
-    """Test if a proxy works by making a request to httpbin.org/ip."""
-    try:
-        response = requests.get('https://httpbin.org/ip', proxies={'https': proxy}, timeout=5)
-        if response.status_code == 200:
-            return True
-        return False
-    except:
-        return False
-
-# Function to fetch and filter proxies from the new provider
-def fetch_free_proxies():
-    """Fetch HTTPS proxies from https://www.proxy-list.download/api/v1/get and filter bad ones."""
-    url = 'https://www.proxy-list.download/api/v1/get?type=https'
-    proxies = []
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        
-        # Parse as plain text (newline-separated)
-        proxy_list = response.text.strip().split('\n')
-        
-        for line in proxy_list:
-            line = line.strip()
-            if ':' in line:  # Basic validation for IP:PORT
-                proxy = f'https://{line}'
-                proxies.append(proxy)
-        
-        logger.info(f"Fetched {len(proxies)} HTTPS proxies. Testing...")
-        
-        # Filter proxies (test up to 40)
-        tested_proxies = []
-        for proxy in proxies[:40]:
-            if test_proxy(proxy):
-                tested_proxies.append(proxy)
-                logger.info(f"Proxy {proxy} is working.")
-            else:
-                logger.warning(f"Proxy {proxy} failed test.")
-        
-        logger.info(f"Filtered to {len(tested_proxies)} working HTTPS proxies.")
-        return tested_proxies
-    except Exception as e:
-        logger.error(f"Error fetching proxies: {str(e)}")
-        return []
+# Batches: a playlist or list of URLs converted as child jobs and downloaded as one ZIP
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", "200"))
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", "4"))  # children of one batch submitted at once
+BATCH_RETRY_INTERVAL = 5.0  # seconds to wait when the scheduler's queue is full
 
-# List of proxies (populate dynamically)
-PROXIES = fetch_free_proxies()
+class BatchRequest(BaseModel):
+    playlist_url: Optional[str] = None
+    youtube_urls: Optional[List[str]] = Field(None, min_length=1, max_length=MAX_BATCH_ITEMS)
+    format: OutputFormat = "mp3"
+    bitrate: Optional[str] = Field(None, pattern=BITRATE_PATTERN)
 
-def get_random_proxy():
-    """Select a random proxy from the list."""
-    return random.choice(PROXIES) if PROXIES else None  # Re-enable proxies
+async def run_batch_item(batch_id, batch_lock, index, item, output_format, bitrate, client):
+    """Convert one video of a batch as a child job and wait for it to finish.
 
-# Example usage in convert_youtube_to_mp3
-async def convert_youtube_to_mp3(youtube_url, job_id):
-    async with conversion_semaphore:
+    ``batch_lock`` guards read-modify-writes of the batch record.
+    """
+    job_id = str(uuid.uuid4())
+    output = describe_output(item["youtube_url"], output_format, bitrate)
+    outputs = [dict(output, filename=f"{job_id}.{output['ext']}")]
+    while True:
         try:
-            start_time = time.time()
-            logger.info(f"Job {job_id}: Starting conversion process.")
-
-            # Get a random proxy
-            proxy = get_random_proxy()
-            proxy_flag = ['--proxy', proxy] if proxy else []
-            logger.info(f"Job {job_id}: Using proxy {proxy}.")
-
-            # Fetch audio stream URL (optimized with proxy)
-            step_start = time.time()
-            yt_dlp_process = await asyncio.create_subprocess_exec(
-                "yt-dlp", "-f", "bestaudio", "--no-playlist", "-o", "-", "--http-chunk-size", "10M", "--cookies", COOKIES_FILE, youtube_url,
-                *proxy_flag,  # Add proxy flag
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            logger.info(f"Job {job_id}: yt-dlp process started. Time taken: {time.time() - step_start:.2f} seconds.")
-
-            # Start ffmpeg process (optimized)
-            step_start = time.time()
-            ffmpeg_process = await asyncio.create_subprocess_exec(
-                "ffmpeg", "-i", "pipe:0", "-f", "mp3", "-b:a", "96k", "-vn",  # Reduced bitrate for speed
-                "-preset", "ultrafast", "-threads", "4", f"/tmp/{job_id}.mp3",
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+            job_id, missing = await submit_conversion(item["youtube_url"], job_id, outputs, client)
+            break
+        except QueueFull:
+            await asyncio.sleep(BATCH_RETRY_INTERVAL)
+
+    async with batch_lock:
+        batch = await job_store.get(batch_id)
+        batch["items"][index].update(job_id=job_id, status="converting")
+        await job_store.update(batch_id, items=batch["items"])
+
+    if missing:
+        await convert_youtube_to_mp3(item["youtube_url"], job_id, missing)
+    else:
+        async for _ in watch_job(job_id):
+            pass
+    job = (await resolve_job(job_id))[1] or {"status": "error", "error": "job expired"}
+    return job["status"], job.get("error")
+
+async def run_batch(batch_id, output_format, bitrate, client):
+    """Run a batch's children, BATCH_PARALLELISM at a time, recording each as it finishes."""
+    slots = asyncio.Semaphore(BATCH_PARALLELISM)
+    batch_lock = asyncio.Lock()
+
+    async def run_item(index, item):
+        async with slots:
+            try:
+                status, error = await run_batch_item(batch_id, batch_lock, index, item, output_format, bitrate, client)
+            except Exception as e:
+                status, error = "error", str(e)
+        if error:
+            logger.error(f"Batch {batch_id}: {item['youtube_url']} failed: {error}")
+        async with batch_lock:
+            batch = await job_store.get(batch_id)
+            batch["items"][index].update(status=status, error=error)
+            batch["finished"].append(index)
+            await job_store.update(
+                batch_id, items=batch["items"], finished=batch["finished"],
+                completed=batch["completed"] + (status == "done"), failed=batch["failed"] + (status != "done"),
+                progress=int(len(batch["finished"]) * 100 / batch["total"]),
             )
-            logger.info(f"Job {job_id}: ffmpeg process started. Time taken: {time.time() - step_start:.2f} seconds.")
-
-            # Pipe data (optimized)
-            step_start = time.time()
-            await pipe_streams(yt_dlp_process, ffmpeg_process)
-            logger.info(f"Job {job_id}: Data piped in {time.time() - step_start:.2f} seconds.")
-
-            # Wait for ffmpeg to finish and capture output
-            stdout, stderr = await ffmpeg_process.communicate()
-            if stderr:
-                logger.error(f"Job {job_id}: ffmpeg stderr: {stderr.decode().strip()}")
-            if ffmpeg_process.returncode != 0:
-                logger.error(f"Job {job_id}: ffmpeg failed with return code {ffmpeg_process.returncode}")
-                conversion_jobs[job_id]["status"] = "error"
-                conversion_jobs[job_id]["error"] = f"ffmpeg failed: {stderr.decode().strip() if stderr else 'Unknown error'}"
-                return
 
-            # Check if file was created
-            file_path = f"/tmp/{job_id}.mp3"
-            if os.path.exists(file_path):
-                logger.info(f"Job {job_id}: File created successfully at {file_path}")
-                conversion_jobs[job_id]["status"] = "done"
-                conversion_jobs[job_id]["download_url"] = f"/download/{job_id}.mp3"
-            else:
-                logger.error(f"Job {job_id}: File not created at {file_path}")
-                conversion_jobs[job_id]["status"] = "error"
-                conversion_jobs[job_id]["error"] = "File creation failed"
-        except Exception as e:
-            logger.error(f"Job {job_id}: Conversion failed: {str(e)}")
-            conversion_jobs[job_id]["status"] = "error"
-            conversion_jobs[job_id]["error"] = str(e)
-
-async def pipe_streams(yt_dlp_process, ffmpeg_process):
+    items = (await job_store.get(batch_id))["items"]
+    await asyncio.gather(*(run_item(index, item) for index, item in enumerate(items)))
+    logger.info(f"Batch {batch_id}: All {len(items)} items finished.")
+    await job_store.update(batch_id, status="done")
+
+@app.post("/start_batch")
+async def start_batch(request: BatchRequest, background_tasks: BackgroundTasks, http_request: Request):
     try:
-        logger.info("Starting to pipe data from yt-dlp to ffmpeg.")
-        total_bytes = 0
-        chunk_size = 1048576  # 1 MB chunks (increased for speed)
-        while True:
-            chunk = await yt_dlp_process.stdout.read(chunk_size)
-            if not chunk:
-                break
-            total_bytes += len(chunk)
-            ffmpeg_process.stdin.write(chunk)
-        await ffmpeg_process.stdin.drain()
-        ffmpeg_process.stdin.close()
-        logger.info(f"Finished piping data. Total bytes transferred: {total_bytes}")
+        batch_id = str(uuid.uuid4())
+        if request.playlist_url:
+            logger.info(f"Batch {batch_id}: Expanding playlist {request.playlist_url}")
+            items = await metadata_cache.playlist_entries(request.playlist_url, MAX_BATCH_ITEMS)
+        else:
+            items = [{"youtube_url": url, "title": None} for url in request.youtube_urls or []]
+        if not items:
+            return {"error": "No videos to convert"}
+
+        await job_store.create(batch_id, {
+            "status": "converting", "progress": 0, "error": None,
+            "total": len(items), "completed": 0, "failed": 0,
+            "items": [dict(item, job_id=None, status="queued", error=None) for item in items],
+            "finished": [],  # Item indexes in the order they finished
+            "download_url": f"/download_batch/{batch_id}.zip",
+        })
+        background_tasks.add_task(run_batch, batch_id, request.format, request.bitrate, client_id(http_request))
+        logger.info(f"Batch {batch_id}: {len(items)} items added to background.")
+        return {"job_id": batch_id, "total": len(items)}
     except Exception as e:
-        logger.error(f"Error during piping streams: {str(e)}")
-        raise
-    finally:
-        # Wait for yt-dlp to finish and capture stderr
-        await yt_dlp_process.wait()
-        yt_dlp_stderr = await yt_dlp_process.stderr.read()
-        if yt_dlp_stderr:
-            logger.error(f"yt-dlp stderr: {yt_dlp_stderr.decode().strip()}")
-        if yt_dlp_process.returncode != 0:
-            logger.error(f"yt-dlp failed with return code {yt_dlp_process.returncode}")
+        logger.error(f"Error in /start_batch: {str(e)}")
+        return {"error": str(e)}
+
+def archive_name(index, item, path):
+    """File name for a batch item inside the ZIP, e.g. "001 - Title.mp3"."""
+    title = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", item.get("title") or "").strip(" ._")[:100]
+    return f"{index + 1:03d} - {title or extract_video_id(item['youtube_url']) or 'track'}{os.path.splitext(path)[1]}"
+
+async def finished_batch_files(batch_id):
+    """Yield (archive name, path) for each converted item of a batch as it finishes."""
+    sent = 0
+    async for batch in watch_job(batch_id):
+        for index in batch.get("finished", [])[sent:]:
+            item = batch["items"][index]
+            job = item["status"] == "done" and (await resolve_job(item["job_id"]))[1]
+            if job and job.get("file_path") and os.path.exists(job["file_path"]):
+                yield archive_name(index, item, job["file_path"]), job["file_path"]
+        sent = len(batch.get("finished", []))
+
+@app.get("/download_batch/{zip_filename}")
+async def download_batch(zip_filename: str):
+    batch_id = os.path.basename(zip_filename).split(".", 1)[0]
+    batch = await job_store.get(batch_id)
+    if not batch or "items" not in batch:
+        return {"error": "Batch not found"}
+    # Tracks are added as they finish, so the download can start right away
+    headers = {"Content-Disposition": f'attachment; filename="{batch_id}.zip"'}
+    return StreamingResponse(zip_files(finished_batch_files(batch_id)), media_type="application/zip", headers=headers)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for this process."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.on_event("startup")
 async def startup_event():
-    # Fetch proxies on startup
-    global PROXIES
-    PROXIES = fetch_free_proxies()
-    logger.info(f"Loaded {len(PROXIES)} proxies on startup.")
-    
-    # Refresh proxies every hour
-    import asyncio
-    async def refresh_proxies():
+    # Load proxies in the background and refresh them every hour
+    app.state.proxy_refresh_task = asyncio.create_task(refresh_proxies())
+
+    # Expire old jobs and delete the files they left in /tmp
+    async def sweep_jobs():
         while True:
-            await asyncio.sleep(3600)  # 1 hour
-            PROXIES = fetch_free_proxies()
-            logger.info(f"Refreshed proxies: {len(PROXIES)} available.")
-    
-    asyncio.create_task(refresh_proxies())
+            await asyncio.sleep(JOB_SWEEP_INTERVAL)
+            removed = await job_store.sweep()
+            for job in removed:
+                file_paths = {job.get("file_path"), *(job.get("file_paths") or {}).values()}
+                # Cached files are shared between jobs and evicted by the cache itself
+                for file_path in file_paths:
+                    if file_path and not conversion_cache.contains_path(file_path):
+                        try:
+                            os.remove(file_path)
+                        except FileNotFoundError:
+                            pass
+            if removed:
+                logger.info(f"Swept {len(removed)} expired jobs.")
+
+    app.state.job_sweep_task = asyncio.create_task(sweep_jobs())
+
+@app.on_event("shutdown")
+async def stop_processes():
+    await supervisor.shutdown()
 
 @app.on_event("startup")
 async def preload_dependencies():
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import yt_dlp
+
+from cache import extract_video_id
+
+logger = logging.getLogger(__name__)
+
+# Resolved stream URLs are signed and expire; stop using them this long before
+METADATA_EXPIRY_MARGIN = 120  # seconds
+# Used when a URL carries no expiry we can read
+METADATA_DEFAULT_TTL = int(os.environ.get("METADATA_DEFAULT_TTL", "300"))
+METADATA_MAX_TTL = 6 * 3600
+METADATA_MAX_ENTRIES = int(os.environ.get("METADATA_MAX_ENTRIES", "1000"))
+
+
+def stream_url_expiry(url):
+    """Return the UNIX time a signed googlevideo URL expires at, or None."""
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get("expire")
+    if not expire:
+        # Manifest URLs carry their parameters in the path: /expire/<ts>/...
+        parts = parsed.path.split("/")
+        if "expire" in parts and parts.index("expire") + 1 < len(parts):
+            expire = [parts[parts.index("expire") + 1]]
+    try:
+        return float(expire[0]) if expire else None
+    except ValueError:
+        return None
+
+
+def _summarize_format(fmt):
+    return {
+        "format_id": fmt.get("format_id"),
+        "ext": fmt.get("ext"),
+        "acodec": fmt.get("acodec"),
+        "vcodec": fmt.get("vcodec"),
+        "abr": fmt.get("abr"),
+        "filesize": fmt.get("filesize") or fmt.get("filesize_approx"),
+    }
+
+
+class MetadataCache:
+    """Extracts video metadata in-process with the yt_dlp API and caches it.
+
+    One extraction returns the title, the available formats and the stream
+    URL for the requested format selector. Entries live until shortly
+    before the signed stream URL expires. Concurrent lookups for the same
+    video and format share a single extraction.
+    """
+
+    def __init__(self, proxy_pool=None, cookies_file=None, max_entries=METADATA_MAX_ENTRIES):
+        self.proxy_pool = proxy_pool
+        self.cookies_file = cookies_file
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (video, fmt) -> (expires_at, info)
+        self._pending = {}  # (video, fmt) -> Future
+
+    def _key(self, youtube_url, fmt):
+        return extract_video_id(youtube_url) or youtube_url.strip(), fmt
+
+    def _extract_sync(self, youtube_url, fmt, proxy):
+        opts = {
+            "format": fmt,
+            "noplaylist": True,
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+        }
+        if self.cookies_file:
+            opts["cookiefile"] = self.cookies_file
+        if proxy:
+            opts["proxy"] = proxy
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(youtube_url, download=False)
+
+        # Same selection -g prints: one URL, or one per merged format
+        selected = info.get("requested_formats") or [info]
+        return {
+            "id": info.get("id"),
+            "title": info.get("title"),
+            "duration": info.get("duration"),
+            "url": "\n".join(f["url"] for f in selected if f.get("url")),
+            "format_id": info.get("format_id"),
+            "ext": info.get("ext"),
+            "acodec": info.get("acodec"),
+            "abr": info.get("abr"),
+            "filesize": info.get("filesize") or info.get("filesize_approx"),
+            "formats": [_summarize_format(f) for f in info.get("formats") or []],
+            "proxy": proxy,
+        }
+
+    async def _extract(self, youtube_url, fmt):
+        proxy = self.proxy_pool.pick() if self.proxy_pool else None
+        start = time.monotonic()
+        try:
+            info = await asyncio.to_thread(self._extract_sync, youtube_url, fmt, proxy)
+        except Exception:
+            if proxy:
+                self.proxy_pool.report_failure(proxy)
+            raise
+        if proxy:
+            self.proxy_pool.report_success(proxy)
+        logger.info(f"Extracted metadata for {youtube_url} ({fmt}) in {time.monotonic() - start:.2f} seconds.")
+        return info
+
+    def _ttl(self, info):
+        now = time.time()
+        expiries = [stream_url_expiry(url) for url in info["url"].split("\n") if url]
+        expiries = [e for e in expiries if e]
+        if not expiries:
+            return METADATA_DEFAULT_TTL
+        return max(0, min(min(expiries) - now - METADATA_EXPIRY_MARGIN, METADATA_MAX_TTL))
+
+    async def extract(self, youtube_url, fmt="bestaudio"):
+        """Return metadata and the stream URL for ``youtube_url`` with format ``fmt``."""
+        key = self._key(youtube_url, fmt)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        pending = self._pending.get(key)
+        if pending:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            # The request doing the extraction was cancelled, not this one: take over
+            return await self.extract(youtube_url, fmt)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            info = await self._extract(youtube_url, fmt)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(info)
+        finally:
+            del self._pending[key]
+
+        ttl = self._ttl(info)
+        if ttl > 0:
+            self._entries[key] = (time.time() + ttl, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return info
+
+    def _playlist_sync(self, playlist_url, max_entries, proxy):
+        opts = {
+            "extract_flat": "in_playlist",
+            "playlistend": max_entries,
+            "quiet": True,
+            "no_warnings": True,
+            "skip_download": True,
+        }
+        if self.cookies_file:
+            opts["cookiefile"] = self.cookies_file
+        if proxy:
+            opts["proxy"] = proxy
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(playlist_url, download=False)
+
+        # A plain video URL comes back as itself rather than as a playlist
+        entries = info.get("entries") if "entries" in info else [info]
+        videos = []
+        for entry in entries or []:
+            if not entry:
+                continue  # Private or deleted videos
+            url = entry.get("webpage_url") or entry.get("url") or entry.get("id")
+            if url:
+                videos.append({"youtube_url": url, "title": entry.get("title")})
+        return videos[:max_entries]
+
+    async def playlist_entries(self, playlist_url, max_entries):
+        """Return the videos of a playlist (or a single video) as ``youtube_url``/``title`` dicts.
+
+        Only the playlist page is read; the videos themselves are extracted
+        when they are converted. Not cached, since playlists change.
+        """
+        proxy = self.proxy_pool.pick() if self.proxy_pool else None
+        start = time.monotonic()
+        try:
+            videos = await asyncio.to_thread(self._playlist_sync, playlist_url, max_entries, proxy)
+        except Exception:
+            if proxy:
+                self.proxy_pool.report_failure(proxy)
+            raise
+        if proxy:
+            self.proxy_pool.report_success(proxy)
+        logger.info(f"Expanded playlist {playlist_url} to {len(videos)} videos in {time.monotonic() - start:.2f} seconds.")
+        return videos
+
+    def invalidate(self, youtube_url, fmt="bestaudio"):
+        """Forget a cached entry, e.g. after its stream URL was rejected."""
+        self._entries.pop(self._key(youtube_url, fmt), None)
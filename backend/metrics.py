@@ -0,0 +1,72 @@
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+# Conversions take from well under a second (remux of a cached source) to
+# several minutes (long videos through a slow proxy)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+QUEUE_WAIT = Histogram(
+    "converter_queue_wait_seconds", "Time spent waiting for a scheduler slot", ["kind"], buckets=DURATION_BUCKETS,
+)
+SPAWN_LATENCY = Histogram("converter_spawn_seconds", "Time to start the yt-dlp and ffmpeg processes", ["kind"])
+FIRST_BYTE = Histogram(
+    "converter_first_byte_seconds", "Time from starting yt-dlp to its first downloaded byte", buckets=DURATION_BUCKETS,
+)
+TRANSFER_DURATION = Histogram(
+    "converter_transfer_seconds", "Time from starting yt-dlp until it finished downloading", buckets=DURATION_BUCKETS,
+)
+ENCODE_DURATION = Histogram(
+    "converter_encode_seconds", "Time from starting ffmpeg until it finished writing", buckets=DURATION_BUCKETS,
+)
+BYTES_PIPED = Counter("converter_piped_bytes", "Source bytes fed from yt-dlp into ffmpeg")
+# In "direct" pipeline mode only stream output passes through Python
+BYTES_RELAYED = Counter("converter_relayed_bytes", "Audio bytes copied through this process", ["kind"])
+JOB_OUTCOMES = Counter(
+    "converter_jobs", "Conversion requests by outcome (done, error, cached, attached, rejected, cancelled)", ["outcome"],
+)
+ACTIVE_JOBS = Gauge("converter_active_jobs", "Conversions and streams currently holding scheduler slots")
+QUEUED_JOBS = Gauge("converter_queued_jobs", "Conversions and streams waiting for scheduler slots")
+CHILD_PROCESSES = Gauge("converter_child_processes", "yt-dlp and ffmpeg processes that haven't been reaped yet")
+PROCESS_KILLS = Counter(
+    "converter_process_kills", "Child processes killed, by reason (timeout, idle, aborted, shutdown)", ["reason"],
+)
+
+
+class ProxyCollector:
+    """Exports the ProxyPool's per-proxy counts, success rate and latency at scrape time."""
+
+    def __init__(self, proxy_pool):
+        self.proxy_pool = proxy_pool
+
+    def collect(self):
+        requests = CounterMetricFamily(
+            "converter_proxy_requests", "Requests made through each proxy, by result", labels=["proxy", "result"],
+        )
+        success_rate = GaugeMetricFamily(
+            "converter_proxy_success_rate", "Smoothed share of requests through each proxy that succeeded", labels=["proxy"],
+        )
+        latency = GaugeMetricFamily(
+            "converter_proxy_latency_seconds", "Moving average latency of each proxy", labels=["proxy"],
+        )
+        for stats in self.proxy_pool.stats():
+            requests.add_metric([stats["proxy"], "success"], stats["successes"])
+            requests.add_metric([stats["proxy"], "failure"], stats["failures"])
+            success_rate.add_metric([stats["proxy"]], stats["success_rate"])
+            if stats["latency"] is not None:
+                latency.add_metric([stats["proxy"]], stats["latency"])
+        yield requests
+        yield success_rate
+        yield latency
+
+
+def register_proxy_pool(proxy_pool):
+    REGISTRY.register(ProxyCollector(proxy_pool))
+
+
+def track_scheduler(scheduler):
+    ACTIVE_JOBS.set_function(lambda: scheduler.stats()["running"])
+    QUEUED_JOBS.set_function(lambda: scheduler.stats()["queued"])
+
+
+def track_supervisor(supervisor):
+    CHILD_PROCESSES.set_function(lambda: len(supervisor.running))
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import time
+
+from supervisor import supervisor
+
+logger = logging.getLogger(__name__)
+
+# "direct" connects yt-dlp stdout to ffmpeg stdin with an OS pipe so the
+# audio never passes through Python. "relay" copies it through the event
+# loop with bounded buffering, for platforms where that isn't possible.
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "direct")
+RELAY_CHUNK_SIZE = 64 * 1024
+
+# Machine-readable yt-dlp download progress, one line per update on stderr
+YT_DLP_PROGRESS_PREFIX = "[progress] "
+YT_DLP_PROGRESS_ARGS = [
+    "--newline",
+    "--progress-template",
+    "download:" + YT_DLP_PROGRESS_PREFIX + "%(progress.downloaded_bytes)s %(progress.total_bytes,progress.total_bytes_estimate)s %(info.duration)s",
+]
+
+# Machine-readable ffmpeg progress on stdout, one key=value block per update
+FFMPEG_PROGRESS_ARGS = ["-progress", "pipe:1", "-nostats"]
+
+
+def parse_yt_dlp_progress(line):
+    """Parse a progress template line into (downloaded_bytes, total_bytes, duration).
+
+    ``total_bytes`` and ``duration`` are None when yt-dlp doesn't know them.
+    """
+    if not line.startswith(YT_DLP_PROGRESS_PREFIX):
+        return None
+    fields = line[len(YT_DLP_PROGRESS_PREFIX):].split()
+    try:
+        downloaded = int(float(fields[0]))
+    except (IndexError, ValueError):
+        return None
+    try:
+        total = int(float(fields[1]))
+    except (IndexError, ValueError):
+        total = None
+    try:
+        duration = float(fields[2])
+    except (IndexError, ValueError):
+        duration = None
+    return downloaded, total, duration
+
+
+def parse_ffmpeg_progress(block):
+    """Turn one ``-progress`` block into (encoded_seconds, output_bytes, finished)."""
+    encoded_seconds = None
+    # out_time_us is the documented key; out_time_ms is also in microseconds
+    for key in ("out_time_us", "out_time_ms"):
+        try:
+            encoded_seconds = int(block[key]) / 1_000_000
+            break
+        except (KeyError, ValueError):
+            continue
+    try:
+        output_bytes = int(block["total_size"])
+    except (KeyError, ValueError):
+        output_bytes = None
+    return encoded_seconds, output_bytes, block.get("progress") == "end"
+
+
+async def start_pipeline(yt_dlp_args, ffmpeg_args, mode=PIPELINE_MODE):
+    """Start yt-dlp and ffmpeg with yt-dlp's output feeding ffmpeg's input.
+
+    ``yt_dlp_args`` must make yt-dlp write to stdout (``-o -``) and
+    ``ffmpeg_args`` must read from stdin (``-i pipe:0``). Both run under
+    the supervisor, ffmpeg with yt-dlp as its upstream.
+    """
+    if mode == "direct":
+        read_fd, write_fd = os.pipe()
+        yt_dlp_process = None
+        try:
+            yt_dlp_process = await supervisor.spawn(
+                *yt_dlp_args, stage="download", stdout=write_fd, stderr=asyncio.subprocess.PIPE,
+            )
+            ffmpeg_process = await supervisor.spawn(
+                *ffmpeg_args,
+                stage="encode",
+                stdin=read_fd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except BaseException:
+            if yt_dlp_process:
+                yt_dlp_process.kill()
+                await yt_dlp_process.wait()
+            raise
+        finally:
+            # The children hold their own ends now; ours would stop EOF/EPIPE
+            os.close(read_fd)
+            os.close(write_fd)
+        ffmpeg_process.upstream = yt_dlp_process
+        return yt_dlp_process, ffmpeg_process
+
+    yt_dlp_process = await supervisor.spawn(
+        *yt_dlp_args, stage="download", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        ffmpeg_process = await supervisor.spawn(
+            *ffmpeg_args,
+            stage="encode",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except BaseException:
+        yt_dlp_process.kill()
+        await yt_dlp_process.wait()
+        raise
+    ffmpeg_process.upstream = yt_dlp_process
+    return yt_dlp_process, ffmpeg_process
+
+
+async def read_yt_dlp_stderr(yt_dlp_process, on_progress=None):
+    """Consume yt-dlp stderr, reporting download progress as it arrives.
+
+    Returns the tail of the non-progress output and the last downloaded
+    byte count.
+    """
+    downloaded = 0
+    while True:
+        line = await yt_dlp_process.stderr.readline()
+        if not line:
+            break
+        yt_dlp_process.touch()
+        text = line.decode(errors="replace").strip()
+        progress = parse_yt_dlp_progress(text)
+        if progress is None:
+            if text:
+                yt_dlp_process.stderr_tail.append(text)
+            continue
+        downloaded = progress[0]
+        if on_progress:
+            on_progress(*progress)
+    return str(yt_dlp_process.stderr_tail), downloaded
+
+
+async def read_ffmpeg_progress(ffmpeg_process, on_progress=None):
+    """Consume ffmpeg stdout, calling ``on_progress`` for every ``-progress`` block."""
+    block = {}
+    while True:
+        line = await ffmpeg_process.stdout.readline()
+        if not line:
+            break
+        key, sep, value = line.decode(errors="replace").strip().partition("=")
+        if not sep:
+            continue
+        block[key] = value
+        if key == "progress":
+            ffmpeg_process.touch()
+            if on_progress:
+                on_progress(*parse_ffmpeg_progress(block))
+            block = {}
+
+
+async def pipe_streams(yt_dlp_process, ffmpeg_process, chunk_size=RELAY_CHUNK_SIZE):
+    """Relay yt-dlp stdout into ffmpeg stdin, waiting for ffmpeg to keep up.
+
+    Awaiting ``drain()`` after every write means at most one chunk plus the
+    transport's high-water mark is buffered in Python, however slow ffmpeg is.
+    """
+    logger.info("Starting to pipe data from yt-dlp to ffmpeg.")
+    total_bytes = 0
+    try:
+        while True:
+            chunk = await yt_dlp_process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            total_bytes += len(chunk)
+            yt_dlp_process.touch()
+            ffmpeg_process.stdin.write(chunk)
+            await ffmpeg_process.stdin.drain()
+        logger.info(f"Finished piping data. Total bytes transferred: {total_bytes}")
+        return total_bytes
+    except Exception as e:
+        logger.error(f"Error during piping streams: {str(e)}")
+        raise
+    finally:
+        ffmpeg_process.stdin.close()
+
+
+async def run_pipeline(yt_dlp_process, ffmpeg_process, on_progress=None, on_encode_progress=None):
+    """Wait for a pipeline from ``start_pipeline`` to finish.
+
+    ``on_progress`` receives yt-dlp download progress and
+    ``on_encode_progress`` receives ffmpeg progress, if ffmpeg was started
+    with ``FFMPEG_PROGRESS_ARGS``.
+
+    Returns a dict with the bytes moved from yt-dlp to ffmpeg (and how
+    many of them were relayed through this process), the end of the
+    stderr output of both processes and timings in seconds from the call:
+    ``first_byte_seconds`` (None if nothing was downloaded),
+    ``transfer_seconds`` until yt-dlp exited and ``encode_seconds`` until
+    ffmpeg exited.
+    """
+    started = time.monotonic()
+    first_byte_seconds = None
+
+    def progress(downloaded, total, duration):
+        nonlocal first_byte_seconds
+        if first_byte_seconds is None and downloaded:
+            first_byte_seconds = time.monotonic() - started
+        if on_progress:
+            on_progress(downloaded, total, duration)
+
+    yt_dlp_stderr_task = asyncio.create_task(read_yt_dlp_stderr(yt_dlp_process, progress))
+    ffmpeg_stderr_task = asyncio.create_task(ffmpeg_process.read_stderr())
+    ffmpeg_progress_task = asyncio.create_task(read_ffmpeg_progress(ffmpeg_process, on_encode_progress))
+    relayed_bytes = None
+    try:
+        if yt_dlp_process.stdout is not None:
+            relayed_bytes = await pipe_streams(yt_dlp_process, ffmpeg_process)
+        await yt_dlp_process.wait()
+    except BaseException:
+        # Cancelled or failed: don't leave either process running
+        yt_dlp_process.kill()
+        ffmpeg_process.kill()
+        raise
+    finally:
+        await yt_dlp_process.wait()
+        transfer_seconds = time.monotonic() - started
+        # A killed download would otherwise be encoded as if it were complete
+        if yt_dlp_process.kill_reason:
+            ffmpeg_process.kill()
+        yt_dlp_stderr, downloaded = await yt_dlp_stderr_task
+        ffmpeg_stderr = await ffmpeg_stderr_task
+        await ffmpeg_progress_task
+        await ffmpeg_process.wait()
+        encode_seconds = time.monotonic() - started
+
+    if yt_dlp_stderr:
+        logger.warning(f"yt-dlp stderr: {yt_dlp_stderr}")
+    if yt_dlp_process.returncode != 0:
+        logger.error(f"yt-dlp failed with return code {yt_dlp_process.returncode}")
+
+    return {
+        "bytes": relayed_bytes if relayed_bytes is not None else downloaded,
+        "relayed_bytes": relayed_bytes or 0,
+        "yt_dlp_stderr": yt_dlp_stderr,
+        "ffmpeg_stderr": ffmpeg_stderr,
+        "first_byte_seconds": first_byte_seconds,
+        "transfer_seconds": transfer_seconds,
+        "encode_seconds": encode_seconds,
+    }
+
+
+async def start_ffmpeg(ffmpeg_args):
+    """Start ffmpeg reading from a stdin we write to (``-i pipe:0``)."""
+    return await supervisor.spawn(
+        *ffmpeg_args,
+        stage="encode",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def run_feed(source, ffmpeg_process, total=None, duration=None, on_progress=None, on_encode_progress=None):
+    """Like ``run_pipeline``, for audio produced in this process.
+
+    ``source`` is an async iterable of byte chunks (e.g. from
+    ``RangedDownloader.stream``) that is written to ffmpeg's stdin.
+    If it raises, ffmpeg is killed rather than left to finish a
+    truncated file, and the error is re-raised.
+    """
+    started = time.monotonic()
+    first_byte_seconds = None
+    fed = 0
+    ffmpeg_stderr_task = asyncio.create_task(ffmpeg_process.read_stderr())
+    ffmpeg_progress_task = asyncio.create_task(read_ffmpeg_progress(ffmpeg_process, on_encode_progress))
+    try:
+        async for chunk in source:
+            if first_byte_seconds is None:
+                first_byte_seconds = time.monotonic() - started
+            ffmpeg_process.touch()
+            ffmpeg_process.stdin.write(chunk)
+            await ffmpeg_process.stdin.drain()
+            fed += len(chunk)
+            if on_progress:
+                on_progress(fed, total, duration)
+    except BaseException:
+        ffmpeg_process.kill()
+        raise
+    finally:
+        transfer_seconds = time.monotonic() - started
+        ffmpeg_process.stdin.close()
+        ffmpeg_stderr = await ffmpeg_stderr_task
+        await ffmpeg_progress_task
+        await ffmpeg_process.wait()
+        encode_seconds = time.monotonic() - started
+    logger.info(f"Fed {fed} bytes to ffmpeg.")
+
+    return {
+        "bytes": fed,
+        "relayed_bytes": fed,
+        "ffmpeg_stderr": ffmpeg_stderr,
+        "first_byte_seconds": first_byte_seconds,
+        "transfer_seconds": transfer_seconds,
+        "encode_seconds": encode_seconds,
+    }
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+PROXY_LIST_URL = os.environ.get("PROXY_LIST_URL", "https://www.proxy-list.download/api/v1/get?type=https")
+PROXY_TEST_URL = os.environ.get("PROXY_TEST_URL", "https://httpbin.org/ip")
+
+
+class ProxyStats:
+    """Running health numbers for a single proxy."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None  # exponentially weighted average, seconds
+        self.sidelined_until = 0.0
+
+    @property
+    def success_rate(self):
+        # Laplace smoothing so a single result doesn't decide everything
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def score(self):
+        latency = self.latency if self.latency is not None else 1.0
+        return self.success_rate / max(latency, 0.05)
+
+    def as_dict(self):
+        return {
+            "proxy": self.proxy,
+            "successes": self.successes,
+            "failures": self.failures,
+            "success_rate": round(self.success_rate, 3),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "sidelined": self.sidelined_until > time.time(),
+        }
+
+
+class ProxyPool:
+    """Health-checked pool of HTTPS proxies that favours fast, reliable ones.
+
+    Health checks run concurrently in worker threads so the event loop is
+    never blocked. Callers report the outcome of real requests back with
+    ``report_success``/``report_failure``; a proxy that keeps failing is
+    sidelined for a while instead of being picked again.
+    """
+
+    def __init__(self, list_url=PROXY_LIST_URL, test_url=PROXY_TEST_URL, max_candidates=40,
+                 concurrency=20, timeout=5, failure_threshold=2, sideline_seconds=600):
+        self.list_url = list_url
+        self.test_url = test_url
+        self.max_candidates = max_candidates
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.sideline_seconds = sideline_seconds
+        self._stats = {}
+
+    def __len__(self):
+        return len(self._stats)
+
+    def _fetch_candidates(self):
+        """Download the provider's newline separated IP:PORT list."""
+        response = requests.get(self.list_url, timeout=10)
+        response.raise_for_status()
+        candidates = []
+        for line in response.text.strip().split('\n'):
+            line = line.strip()
+            if ':' in line:  # Basic validation for IP:PORT
+                candidates.append(line if "://" in line else f'https://{line}')
+        return candidates
+
+    def _check_proxy(self, proxy):
+        """Make one request through ``proxy``; return its latency or None."""
+        start = time.monotonic()
+        try:
+            response = requests.get(self.test_url, proxies={'http': proxy, 'https': proxy}, timeout=self.timeout)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        return time.monotonic() - start
+
+    async def health_check(self, proxies):
+        """Test ``proxies`` concurrently and return {proxy: latency or None}."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(proxy):
+            async with semaphore:
+                return proxy, await asyncio.to_thread(self._check_proxy, proxy)
+
+        return dict(await asyncio.gather(*(check(proxy) for proxy in proxies)))
+
+    async def refresh(self):
+        """Fetch a fresh proxy list, test it and replace the pool with the working ones."""
+        try:
+            candidates = await asyncio.to_thread(self._fetch_candidates)
+        except Exception as e:
+            logger.error(f"Error fetching proxies: {str(e)}")
+            return len(self._stats)
+
+        logger.info(f"Fetched {len(candidates)} HTTPS proxies. Testing...")
+        results = await self.health_check(candidates[:self.max_candidates])
+
+        stats = {}
+        for proxy, latency in results.items():
+            if latency is None:
+                logger.warning(f"Proxy {proxy} failed test.")
+                continue
+            # Keep history for proxies we already knew about
+            stats[proxy] = self._stats.get(proxy) or ProxyStats(proxy)
+            self.report_success(proxy, latency, stats=stats[proxy])
+            logger.info(f"Proxy {proxy} is working ({latency:.2f}s).")
+
+        self._stats = stats
+        logger.info(f"Filtered to {len(stats)} working HTTPS proxies.")
+        return len(stats)
+
+    def pick(self):
+        """Pick a proxy, weighted towards fast and reliable ones. None if the pool is empty."""
+        now = time.time()
+        available = [s for s in self._stats.values() if s.sidelined_until <= now]
+        if not available:
+            return None
+        weights = [s.score() for s in available]
+        return random.choices(available, weights=weights)[0].proxy
+
+    def report_success(self, proxy, latency=None, stats=None):
+        stats = stats or self._stats.get(proxy)
+        if stats is None:
+            return
+        stats.successes += 1
+        stats.consecutive_failures = 0
+        if latency is not None:
+            stats.latency = latency if stats.latency is None else 0.7 * stats.latency + 0.3 * latency
+
+    def report_failure(self, proxy):
+        stats = self._stats.get(proxy)
+        if stats is None:
+            return
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if stats.consecutive_failures >= self.failure_threshold:
+            stats.sidelined_until = time.time() + self.sideline_seconds
+            logger.warning(f"Proxy {proxy} sidelined for {self.sideline_seconds}s after {stats.consecutive_failures} failures.")
+
+    def stats(self):
+        return [s.as_dict() for s in self._stats.values()]
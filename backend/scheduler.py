@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+_CPUS = os.cpu_count() or 1
+# Downloads mostly wait on the network, encodes on the CPU
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", str(_CPUS * 2)))
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", str(_CPUS)))
+# Admission control: queued (not yet running) jobs allowed in total and per client
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", "200"))
+MAX_QUEUE_PER_CLIENT = int(os.environ.get("MAX_QUEUE_PER_CLIENT", "20"))
+# Starting guess for how long a job runs, refined as jobs finish
+INITIAL_JOB_DURATION = 30.0  # seconds
+
+
+class QueueFull(Exception):
+    """Raised when a job is rejected because the backlog is too long."""
+
+
+class _Entry:
+    def __init__(self, job_id, client, stages):
+        self.job_id = job_id
+        self.client = client
+        self.stages = stages
+        self.enqueued_at = time.time()
+        self.started = asyncio.get_running_loop().create_future()
+
+
+class Scheduler:
+    """Fair, admission-controlled queue in front of the conversion workers.
+
+    Every job needs a slot in each of its stages ("download", "encode")
+    for as long as it runs; a remux only needs a download slot, so it
+    doesn't wait behind transcodes. Waiting jobs are kept in one FIFO per
+    client and started round-robin across clients, so a client with a
+    long backlog only gets its turn like everyone else.
+    """
+
+    def __init__(self, download_workers=DOWNLOAD_WORKERS, encode_workers=ENCODE_WORKERS,
+                 max_queue=MAX_QUEUE, max_queue_per_client=MAX_QUEUE_PER_CLIENT):
+        self.capacity = {"download": download_workers, "encode": encode_workers}
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self._in_use = {stage: 0 for stage in self.capacity}
+        self._queues = OrderedDict()  # client -> deque of waiting entries, next to serve first
+        self._waiting = {}  # job_id -> entry
+        self._running = {}  # job_id -> (entry, started_at)
+        self._acquiring = deque()  # (entry, stage, future) for running jobs waiting on one more slot
+        self._avg_duration = INITIAL_JOB_DURATION
+
+    def admit(self, job_id, client, stages=("download", "encode")):
+        """Queue ``job_id`` for ``client``, or raise QueueFull."""
+        if len(self._waiting) >= self.max_queue:
+            raise QueueFull("Server is busy, please try again later")
+        queue = self._queues.get(client)
+        if queue and len(queue) >= self.max_queue_per_client:
+            raise QueueFull(f"Too many queued jobs (limit {self.max_queue_per_client})")
+        entry = _Entry(job_id, client, tuple(stages))
+        if queue is None:
+            # A client with nothing waiting goes first, ahead of those with a backlog
+            queue = self._queues[client] = deque()
+            self._queues.move_to_end(client, last=False)
+        queue.append(entry)
+        self._waiting[job_id] = entry
+        self._dispatch()
+
+    def withdraw(self, job_id):
+        """Give up the place, or slots, of an admitted job that won't ``run`` after all."""
+        entry = self._waiting.get(job_id)
+        if entry is not None:
+            self._remove_waiting(entry)
+        elif job_id in self._running:
+            self._release(job_id)
+
+    def can_start(self, stages=("download", "encode")):
+        """Whether a job admitted now would start right away."""
+        return not self._waiting and all(self._in_use[stage] < self.capacity[stage] for stage in stages)
+
+    def _fair_order(self):
+        """Waiting entries in the order they will be started: round-robin over clients."""
+        queues = list(self._queues.values())
+        depth = max((len(q) for q in queues), default=0)
+        for i in range(depth):
+            for queue in queues:
+                if i < len(queue):
+                    yield queue[i]
+
+    def _fits(self, entry):
+        return all(self._in_use[stage] < self.capacity[stage] for stage in entry.stages)
+
+    def _dispatch(self):
+        # Running jobs that need another slot go before jobs yet to start
+        for item in list(self._acquiring):
+            entry, stage, future = item
+            if self._in_use[stage] < self.capacity[stage]:
+                self._acquiring.remove(item)
+                self._in_use[stage] += 1
+                entry.stages += (stage,)
+                future.set_result(None)
+        for entry in list(self._fair_order()):
+            if not self._fits(entry):
+                continue
+            queue = self._queues[entry.client]
+            queue.remove(entry)
+            if queue:
+                self._queues.move_to_end(entry.client)  # Next turn goes to the other clients
+            else:
+                del self._queues[entry.client]
+            del self._waiting[entry.job_id]
+            for stage in entry.stages:
+                self._in_use[stage] += 1
+            self._running[entry.job_id] = (entry, time.time())
+            entry.started.set_result(None)
+
+    def _remove_waiting(self, entry):
+        self._waiting.pop(entry.job_id, None)
+        queue = self._queues.get(entry.client)
+        if queue and entry in queue:
+            queue.remove(entry)
+            if not queue:
+                del self._queues[entry.client]
+
+    def _release(self, job_id):
+        entry, started_at = self._running.pop(job_id)
+        for stage in entry.stages:
+            self._in_use[stage] -= 1
+        self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.time() - started_at)
+        self._dispatch()
+
+    async def acquire(self, job_id, stage):
+        """Add a slot in ``stage`` to those a running job holds, waiting for one if need be.
+
+        For jobs that only find out once they run that they need it, like
+        a planned remux that has to transcode after all. The slot is
+        released with the others when ``run`` exits.
+        """
+        entry = self._running[job_id][0]
+        if stage in entry.stages:
+            return
+        item = (entry, stage, asyncio.get_running_loop().create_future())
+        self._acquiring.append(item)
+        self._dispatch()
+        try:
+            await item[2]
+        except asyncio.CancelledError:
+            if item in self._acquiring:
+                self._acquiring.remove(item)
+            raise
+
+    @asynccontextmanager
+    async def run(self, job_id):
+        """Wait for ``job_id``'s turn, then hold its slots until the block exits.
+
+        Yields the number of seconds the job spent queued.
+        """
+        entry = self._waiting.get(job_id)
+        if entry is None and job_id not in self._running:
+            raise KeyError(f"Job {job_id} was not admitted")
+        if entry is not None:
+            try:
+                await entry.started
+            except asyncio.CancelledError:
+                if entry.started.done():
+                    self._release(job_id)
+                else:
+                    self._remove_waiting(entry)
+                raise
+        else:
+            entry = self._running[job_id][0]
+        try:
+            yield time.time() - entry.enqueued_at
+        finally:
+            self._release(job_id)
+
+    def status(self, job_id):
+        """Queue position (1-based) and estimated start time for a waiting job, else None."""
+        if job_id not in self._waiting:
+            return None
+        position = next(i for i, entry in enumerate(self._fair_order()) if entry.job_id == job_id)
+        slots = max(1, min(self.capacity[stage] for stage in self._waiting[job_id].stages))
+        estimated_wait = math.ceil((position + 1) / slots) * self._avg_duration
+        return {
+            "queue_position": position + 1,
+            "estimated_start": round(time.time() + estimated_wait),
+            "estimated_wait_seconds": round(estimated_wait),
+        }
+
+    def stats(self):
+        return {
+            "queued": len(self._waiting),
+            "running": len(self._running),
+            "in_use": dict(self._in_use),
+            "capacity": dict(self.capacity),
+        }
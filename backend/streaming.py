@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import os
+import time
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+FOLLOW_CHUNK_SIZE = 64 * 1024
+# How often followers re-check a file whose writer can't notify them
+FOLLOW_POLL_INTERVAL = 0.25  # seconds
+# How long a GrowingFile's producer keeps going once its last follower has left
+ABANDON_GRACE = float(os.environ.get("STREAM_ABANDON_GRACE", "5"))
+
+
+class GrowingFile:
+    """A file written by one producer in this process while others read it.
+
+    The producer calls ``advance`` after each write and ``finish`` or
+    ``fail`` at the end; followers read it with ``follow``. If every
+    follower leaves before the end, the producer task is cancelled after
+    ABANDON_GRACE seconds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.task = None  # The producer, kept referenced while it runs
+        self.followers = 0
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def advance(self, nbytes):
+        self.size += nbytes
+        self._wake()
+
+    def finish(self, final_path=None):
+        if final_path:
+            self.path = final_path
+        self.done = True
+        self._wake()
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+        self._wake()
+
+    async def wait_for_more(self):
+        """Wait until more data may be available. False once the writer is finished."""
+        if self.done:
+            if self.error:
+                raise RuntimeError(self.error)
+            return False
+        changed = self._changed
+        try:
+            await asyncio.wait_for(changed.wait(), timeout=FOLLOW_POLL_INTERVAL * 4)
+        except asyncio.TimeoutError:
+            pass
+        return True
+
+    async def follow(self, chunk_size=FOLLOW_CHUNK_SIZE):
+        """``follow_file`` for this file, counting the reader as a follower."""
+        self.followers += 1
+        try:
+            async for chunk in follow_file(self.path, self.wait_for_more, chunk_size):
+                yield chunk
+        finally:
+            self.followers -= 1
+            if not self.followers and not self.done:
+                asyncio.get_running_loop().call_later(ABANDON_GRACE, self._abandon)
+
+    def _abandon(self):
+        if not self.followers and not self.done and self.task:
+            logger.info(f"Nobody is following {self.path} any more; stopping its producer.")
+            self.task.cancel()
+
+
+async def follow_file(path, wait_for_more, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Yield the contents of ``path`` as it is written.
+
+    ``wait_for_more`` is an async callable that returns once more data may
+    have been written, and returns False once the writer has finished.
+    Reading continues from the open file, so the writer may rename it.
+    """
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            if not await wait_for_more():
+                # The writer is done; send whatever arrived since the last read
+                while chunk := f.read(chunk_size):
+                    yield chunk
+                return
+
+
+def _parse_range(range_header, size):
+    """Parse a single ``bytes=`` range into (start, end) inclusive.
+
+    Returns None to serve the whole file (no header, or several ranges)
+    and raises ValueError if the range can't be satisfied.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, sep, end = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            start = max(0, size - length)
+            end = size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {range_header}")
+    if start >= size or start > end:
+        raise ValueError(f"Range not satisfiable: {range_header}")
+    return start, end
+
+
+async def _read_range(f, start, end, chunk_size=FOLLOW_CHUNK_SIZE):
+    with f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, media_type, filename):
+    """Serve a finished file with Range, If-Range and conditional GET support.
+
+    The file is opened up front, so a cached file evicted while it is
+    being sent still arrives whole; one that is already gone is reported
+    as not found.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return JSONResponse({"error": "File not found"})
+    try:
+        response = _file_response(request, f, media_type, filename)
+    except BaseException:
+        f.close()
+        raise
+    if not isinstance(response, StreamingResponse):
+        f.close()
+    return response
+
+
+def _file_response(request, f, media_type, filename):
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    # Finished files are never rewritten in place, so inode and size identify the content
+    etag = f'"{stat.st_ino:x}-{size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp() if if_modified_since else None
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and int(stat.st_mtime) <= since:
+            return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and if_range and if_range.strip() not in (etag, last_modified):
+        range_header = None  # The client's copy is stale; send it all
+
+    try:
+        byte_range = _parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        status_code = 206
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, media_type=media_type, headers=headers)
+    return StreamingResponse(_read_range(f, start, end), status_code=status_code, media_type=media_type, headers=headers)
+
+
+class _ZipBuffer:
+    """Write-only, unseekable sink for ZipFile; the bytes are collected with ``take``."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def zip_files(files, chunk_size=FOLLOW_CHUNK_SIZE):
+    """Yield a ZIP archive of ``files`` as it is built.
+
+    ``files`` is an async iterable of (name in the archive, path) pairs,
+    so entries can be added as they become available. Files are stored
+    uncompressed (audio doesn't compress) and the archive is never held
+    in memory or on disk as a whole; since the output can't be seeked,
+    each entry's sizes and CRC follow its data.
+    """
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        async for name, path in files:
+            with open(path, "rb") as src:
+                stat = os.fstat(src.fileno())
+                info = zipfile.ZipInfo(name, date_time=time.localtime(stat.st_mtime)[:6])
+                info.file_size = stat.st_size
+                with archive.open(info, "w") as dest:
+                    while chunk := src.read(chunk_size):
+                        dest.write(chunk)
+                        yield buffer.take()
+            # The data descriptor, written when the entry is closed
+            yield buffer.take()
+    # The central directory
+    yield buffer.take()
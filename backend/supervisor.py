@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from metrics import PROCESS_KILLS, track_supervisor
+
+logger = logging.getLogger(__name__)
+
+# Limits per stage, in seconds: how long a child may run in total and how
+# long it may go without making progress. 0 disables a limit.
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT", "1800"))
+DOWNLOAD_IDLE_TIMEOUT = float(os.environ.get("DOWNLOAD_IDLE_TIMEOUT", "60"))
+ENCODE_TIMEOUT = float(os.environ.get("ENCODE_TIMEOUT", "1800"))
+ENCODE_IDLE_TIMEOUT = float(os.environ.get("ENCODE_IDLE_TIMEOUT", "60"))
+COMMAND_TIMEOUT = 60.0  # one-off commands like `yt-dlp --version`
+STAGE_LIMITS = {
+    "download": (DOWNLOAD_TIMEOUT, DOWNLOAD_IDLE_TIMEOUT),
+    "encode": (ENCODE_TIMEOUT, ENCODE_IDLE_TIMEOUT),
+    "command": (COMMAND_TIMEOUT, 0),
+}
+
+# Niceness for every child, so the event loop stays responsive under load,
+# and optional caps on each child's address space and CPU time (0 for none)
+CHILD_NICE = int(os.environ.get("CHILD_NICE", "10"))
+CHILD_MAX_MEMORY_MB = int(os.environ.get("CHILD_MAX_MEMORY_MB", "0"))
+CHILD_MAX_CPU_SECONDS = int(os.environ.get("CHILD_MAX_CPU_SECONDS", "0"))
+
+# Only the end of a child's stderr is kept; that's where the error is
+STDERR_TAIL_LINES = 50
+STDERR_MAX_LINE = 4096
+STDERR_READ_SIZE = 16 * 1024
+WATCHDOG_INTERVAL = 1.0  # seconds between limit checks
+
+
+class StderrTail:
+    """The last ``max_lines`` lines written to a stream, however much is written."""
+
+    def __init__(self, max_lines=STDERR_TAIL_LINES):
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self._partial = b""
+
+    def append(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line[:STDERR_MAX_LINE])
+
+    def feed(self, data):
+        """Add raw output, splitting it on newlines and carriage returns."""
+        *complete, self._partial = re.split(rb"[\r\n]", self._partial + data)
+        if len(self._partial) > STDERR_MAX_LINE:
+            complete.append(self._partial)
+            self._partial = b""
+        for line in complete:
+            text = line.decode(errors="replace").strip()
+            if text:
+                self.append(text)
+
+    def close(self):
+        self.feed(b"\n")
+
+    def __str__(self):
+        text = "\n".join(self.lines)
+        if self.dropped:
+            text = f"[{self.dropped} earlier lines dropped]\n{text}"
+        return text
+
+
+class SupervisedProcess:
+    """An ``asyncio.subprocess.Process`` whose limits are enforced by a Supervisor.
+
+    Attributes not defined here fall through to the process, so it can be
+    used in its place. Callers ``touch`` it whenever the child makes
+    progress; ``upstream`` is the process feeding this one, whose progress
+    counts too (ffmpeg waiting on a slow download isn't stalled).
+    """
+
+    def __init__(self, process, name, timeout, idle_timeout):
+        self.process = process
+        self.name = name
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.upstream = None
+        self.started = self.last_progress = time.monotonic()
+        self.stderr_tail = StderrTail()
+        self.kill_reason = None
+        self.error = None  # Why the supervisor killed it, for error messages
+
+    def __getattr__(self, name):
+        return getattr(self.process, name)
+
+    def touch(self):
+        self.last_progress = time.monotonic()
+
+    def idle_seconds(self, now):
+        last_progress = self.last_progress
+        if self.upstream and self.upstream.returncode is None:
+            last_progress = max(last_progress, self.upstream.last_progress)
+        return now - last_progress
+
+    async def read_stderr(self):
+        """Consume stderr into ``stderr_tail`` and return the tail at EOF."""
+        while chunk := await self.process.stderr.read(STDERR_READ_SIZE):
+            self.stderr_tail.feed(chunk)
+        self.stderr_tail.close()
+        return str(self.stderr_tail)
+
+    def kill(self, reason="aborted", error=None):
+        """Kill the process if it is still running; ``wait`` reaps it."""
+        if self.process.returncode is not None or self.kill_reason:
+            return
+        self.kill_reason = reason
+        self.error = error
+        PROCESS_KILLS.labels(reason).inc()
+        logger.warning(f"Killing {self.name} (pid {self.process.pid}): {error or reason}")
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+
+def _apply_limits(pid):
+    """Renice and cap a child from the parent.
+
+    Doing this after the spawn rather than in a preexec_fn keeps the fast
+    vfork/posix_spawn path; the child is only briefly unlimited while it
+    execs.
+    """
+    try:
+        if CHILD_NICE and hasattr(os, "setpriority"):
+            os.setpriority(os.PRIO_PROCESS, pid, min(19, os.getpriority(os.PRIO_PROCESS, pid) + CHILD_NICE))
+        if resource and hasattr(resource, "prlimit"):
+            if CHILD_MAX_MEMORY_MB:
+                limit = CHILD_MAX_MEMORY_MB * 1024 * 1024
+                resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+            if CHILD_MAX_CPU_SECONDS:
+                resource.prlimit(pid, resource.RLIMIT_CPU, (CHILD_MAX_CPU_SECONDS, CHILD_MAX_CPU_SECONDS))
+    except ProcessLookupError:
+        pass  # Already exited
+    except OSError as e:
+        logger.warning(f"Could not limit process {pid}: {str(e)}")
+
+
+class Supervisor:
+    """Starts child processes and enforces their limits until they are reaped.
+
+    A watchdog per child kills it once it exceeds its stage's wall-clock
+    or no-progress limit. Callers still ``wait`` for their children;
+    ``shutdown`` kills and reaps whatever is left.
+    """
+
+    def __init__(self):
+        self.running = set()
+
+    async def spawn(self, *args, stage="command", timeout=None, idle_timeout=None, **kwargs):
+        """Start ``args`` like ``asyncio.create_subprocess_exec``, with ``stage``'s limits."""
+        stage_timeout, stage_idle_timeout = STAGE_LIMITS[stage]
+        process = await asyncio.create_subprocess_exec(*args, **kwargs)
+        _apply_limits(process.pid)
+        supervised = SupervisedProcess(
+            process, os.path.basename(args[0]),
+            stage_timeout if timeout is None else timeout,
+            stage_idle_timeout if idle_timeout is None else idle_timeout,
+        )
+        self.running.add(supervised)
+        supervised.watchdog = asyncio.create_task(self._watch(supervised))
+        return supervised
+
+    async def _watch(self, supervised):
+        exited = asyncio.ensure_future(supervised.process.wait())
+        try:
+            while not (await asyncio.wait({exited}, timeout=WATCHDOG_INTERVAL))[0]:
+                now = time.monotonic()
+                if supervised.timeout and now - supervised.started > supervised.timeout:
+                    supervised.kill("timeout", f"{supervised.name} ran for more than {supervised.timeout:g} seconds")
+                elif supervised.idle_timeout and supervised.idle_seconds(now) > supervised.idle_timeout:
+                    supervised.kill("idle", f"{supervised.name} made no progress for {supervised.idle_timeout:g} seconds")
+        finally:
+            exited.cancel()
+            self.running.discard(supervised)
+
+    async def shutdown(self):
+        """Kill and reap every child that is still running."""
+        running = list(self.running)
+        for supervised in running:
+            supervised.kill("shutdown")
+        await asyncio.gather(*(supervised.process.wait() for supervised in running), return_exceptions=True)
+
+
+supervisor = Supervisor()
+track_supervisor(supervisor)
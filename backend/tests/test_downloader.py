@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+import downloader
+import run
+import synth
+from downloader import DownloadError, RangedDownloader
+
+
+@pytest.fixture(autouse=True)
+def short_audio(monkeypatch):
+    monkeypatch.setattr(synth, "AUDIO_SECONDS", 1.0)
+    monkeypatch.setattr(synth, "SOURCE_RATE", 0)
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)  # Retry backoff
+
+
+def media_handler(fail_first=0, status=503, ranges=True):
+    """A MediaHandler that answers its first ``fail_first`` requests with ``status``."""
+
+    class Handler(run.MediaHandler):
+        requests = []
+
+        def do_GET(self):
+            Handler.requests.append(self.headers.get("Range"))
+            if len(Handler.requests) <= fail_first:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if not ranges:
+                del self.headers["Range"]
+            super().do_GET()
+
+    return Handler
+
+
+def collect(ranged, url, size=None):
+    async def read():
+        return b"".join([chunk async for chunk in ranged.stream(url, size)])
+
+    return asyncio.run(read())
+
+
+def test_probe_returns_size(serve):
+    url = serve(media_handler()) + "/audio/x"
+    assert RangedDownloader()._probe(url) == synth.wav_size()
+
+
+def test_probe_without_range_support(serve):
+    url = serve(media_handler(ranges=False)) + "/audio/x"
+    assert RangedDownloader()._probe(url) is None
+
+
+def test_probe_refused(serve):
+    url = serve(media_handler(fail_first=1, status=403)) + "/audio/x"
+    with pytest.raises(DownloadError):
+        RangedDownloader()._probe(url)
+
+
+def test_fetch_range(serve):
+    url = serve(media_handler()) + "/audio/x"
+    assert RangedDownloader()._fetch_range(url, 100, 199) == b"".join(synth.synthetic_wav())[100:200]
+
+
+def test_fetch_range_retries(serve):
+    handler = media_handler(fail_first=2)
+    url = serve(handler) + "/audio/x"
+    assert len(RangedDownloader(retries=3)._fetch_range(url, 0, 99)) == 100
+    assert handler.requests == ["bytes=0-99"] * 3
+
+
+def test_fetch_range_gives_up(serve):
+    handler = media_handler(fail_first=10)
+    url = serve(handler) + "/audio/x"
+    with pytest.raises(DownloadError, match="after 2 attempts"):
+        RangedDownloader(retries=1)._fetch_range(url, 0, 99)
+    assert len(handler.requests) == 2
+
+
+def test_fetch_range_refused_is_not_retried(serve):
+    handler = media_handler(fail_first=10, status=403)
+    url = serve(handler) + "/audio/x"
+    with pytest.raises(DownloadError, match="HTTP 403"):
+        RangedDownloader(retries=3)._fetch_range(url, 0, 99)
+    assert len(handler.requests) == 1
+
+
+def test_stream_reassembles_ranges_in_order(serve):
+    handler = media_handler()
+    url = serve(handler) + "/audio/x"
+    body = collect(RangedDownloader(connections=4, chunk_size=10000), url)
+    assert body == b"".join(synth.synthetic_wav())
+    # The probe, then one request per range
+    assert len(handler.requests) == 1 + -(-synth.wav_size() // 10000)
+
+
+def test_stream_with_known_size_skips_probe(serve):
+    handler = media_handler()
+    url = serve(handler) + "/audio/x"
+    body = collect(RangedDownloader(chunk_size=65536), url, size=synth.wav_size())
+    assert body == b"".join(synth.synthetic_wav())
+    assert "bytes=0-0" not in handler.requests
+
+
+def test_stream_without_range_support(serve):
+    url = serve(media_handler(ranges=False)) + "/audio/x"
+    assert collect(RangedDownloader(chunk_size=10000), url) == b"".join(synth.synthetic_wav())
@@ -0,0 +1,106 @@
+import asyncio
+import random
+import socket
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+from proxy_pool import ProxyPool
+
+
+def proxy_handler(status=200, delay=0.0, proxies=()):
+    """Answers every request, proxied or not, with ``status`` after ``delay`` seconds.
+
+    /proxies lists ``proxies``, one per line, for ProxyPool.refresh.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = "\n".join(proxies).encode() if self.path.endswith("/proxies") else b'{"origin": "127.0.0.1"}'
+            time.sleep(delay)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def dead_proxy():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def make_pool(serve, proxies=(), **kwargs):
+    """A pool that fetches ``proxies`` and tests them against a local URL, which they proxy themselves."""
+    server = serve(proxy_handler(proxies=proxies))
+    return ProxyPool(list_url=server + "/proxies", test_url=server + "/ip", timeout=2, **kwargs)
+
+
+def test_health_check(serve, dead_proxy):
+    pool = make_pool(serve)
+    working = serve(proxy_handler())
+    refusing = serve(proxy_handler(status=502))
+    results = asyncio.run(pool.health_check([working, refusing, dead_proxy]))
+    assert results[working] is not None and results[working] < 2
+    assert results[refusing] is None
+    assert results[dead_proxy] is None
+
+
+def test_refresh_keeps_working_proxies(serve, dead_proxy):
+    working = serve(proxy_handler())
+    pool = make_pool(serve, [working, dead_proxy])
+    assert asyncio.run(pool.refresh()) == 1
+    assert [s["proxy"] for s in pool.stats()] == [working]
+    assert pool.pick() == working
+
+
+def test_pick_from_empty_pool():
+    assert ProxyPool().pick() is None
+
+
+def test_pick_favours_fast_proxies(serve):
+    fast = serve(proxy_handler())
+    slow = serve(proxy_handler(delay=0.3))
+    pool = make_pool(serve, [fast, slow])
+    assert asyncio.run(pool.refresh()) == 2
+    random.seed(1)
+    picks = [pool.pick() for _ in range(1000)]
+    # Equally reliable, so picked in inverse proportion to latency: over 6:1 here
+    assert picks.count(fast) > 800
+    assert picks.count(slow) > 0
+
+
+def test_report_failure_sidelines(serve):
+    proxy = serve(proxy_handler())
+    pool = make_pool(serve, [proxy], failure_threshold=2, sideline_seconds=0.5)
+    asyncio.run(pool.refresh())
+
+    pool.report_failure(proxy)
+    assert pool.pick() == proxy
+    # A success in between resets the count
+    pool.report_success(proxy)
+    pool.report_failure(proxy)
+    assert pool.pick() == proxy
+
+    pool.report_failure(proxy)
+    assert pool.pick() is None
+    assert pool.stats()[0]["sidelined"]
+    assert pool.stats()[0]["failures"] == 3
+
+    time.sleep(0.6)
+    assert pool.pick() == proxy
+
+
+def test_report_for_unknown_proxy_is_ignored():
+    pool = ProxyPool()
+    pool.report_failure("http://127.0.0.1:1")
+    pool.report_success("http://127.0.0.1:1", latency=0.1)
+    assert pool.stats() == []
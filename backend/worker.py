@@ -0,0 +1,124 @@
+"""Conversion worker: takes jobs from the job queue and runs them.
+
+Start the API and any number of workers with the same JOB_QUEUE_PATH,
+JOB_STORE_PATH and CACHE_DIR (and WORK_DIR, for progressive downloads):
+
+    JOB_QUEUE_PATH=/data/queue.db JOB_STORE_PATH=/data/jobs.db python worker.py
+
+Each worker runs as many conversions at once as its DOWNLOAD_WORKERS and
+ENCODE_WORKERS allow, and reports progress through the job store.
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from conversion import cancel_conversion, convert_youtube_to_mp3, job_store, refresh_proxies, scheduler, scheduler_stages
+from job_queue import JOB_MAX_ATTEMPTS, create_job_queue
+from job_store import JOB_STORE_PATH
+from prometheus_client import start_http_server
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_POLL_INTERVAL = 1.0  # seconds between looks at an empty queue
+CANCEL_POLL_INTERVAL = 2.0  # seconds between checks for cancellation through the API
+# Port to serve this worker's Prometheus metrics on; unset to not serve them
+WORKER_METRICS_PORT = os.environ.get("WORKER_METRICS_PORT")
+
+
+async def run_job(job_queue, job_id, payload):
+    """Convert one claimed job, renewing its lease until it is finished.
+
+    Cancellation through the API only reaches this process via the job
+    store, so that is checked every CANCEL_POLL_INTERVAL. A job whose
+    lease is lost is stopped and left to the worker that holds it now.
+    """
+    lease_lost = False
+
+    async def keep_lease():
+        nonlocal lease_lost
+        renewed = asyncio.get_running_loop().time()
+        while True:
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+            if (await job_store.get(job_id) or {}).get("cancelled"):
+                cancel_conversion(job_id)
+            if asyncio.get_running_loop().time() - renewed >= job_queue.lease_seconds / 3:
+                renewed = asyncio.get_running_loop().time()
+                if not await job_queue.renew(job_id, WORKER_ID):
+                    # Another worker may have taken it over; don't convert it twice
+                    logger.warning(f"Job {job_id}: Lease lost; stopping the conversion.")
+                    lease_lost = True
+                    if not cancel_conversion(job_id, keep_outputs=True):
+                        conversion.cancel()  # Hasn't started yet
+                    return
+
+    conversion = None
+    renewer = asyncio.create_task(keep_lease())
+    try:
+        scheduler.admit(job_id, WORKER_ID, scheduler_stages(payload["outputs"]))
+        conversion = asyncio.create_task(
+            convert_youtube_to_mp3(payload["youtube_url"], job_id, payload["outputs"], payload.get("download"))
+        )
+        await conversion
+    except asyncio.CancelledError:
+        if not lease_lost:
+            raise
+    finally:
+        renewer.cancel()
+        scheduler.withdraw(job_id)
+        # The job is someone else's now; only its holder may ack it
+        if not lease_lost:
+            await job_queue.ack(job_id)
+
+
+async def main():
+    job_queue = create_job_queue()
+    if job_queue is None:
+        raise SystemExit("Set JOB_QUEUE_PATH to the queue shared with the API.")
+    if not JOB_STORE_PATH:
+        logger.warning("JOB_STORE_PATH is not set; job status will not reach the API.")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    if WORKER_METRICS_PORT:
+        start_http_server(int(WORKER_METRICS_PORT))
+    proxy_refresh_task = asyncio.create_task(refresh_proxies())
+    running = set()
+    logger.info(f"Worker {WORKER_ID} started.")
+    while not stopping.is_set():
+        claimed = await job_queue.claim(WORKER_ID) if scheduler.can_start() else None
+        if claimed is None:
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        job_id, payload, attempts = claimed
+        if attempts > JOB_MAX_ATTEMPTS:
+            logger.error(f"Job {job_id}: Giving up after {attempts - 1} interrupted attempts.")
+            await job_store.update(job_id, status="error", error="Conversion was interrupted too many times")
+            await job_queue.ack(job_id)
+            continue
+        logger.info(f"Job {job_id}: Claimed by worker {WORKER_ID}.")
+        task = asyncio.create_task(run_job(job_queue, job_id, payload))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    # Finish what we started; anything unclaimed stays queued for other workers
+    logger.info(f"Worker {WORKER_ID} stopping; waiting for {len(running)} jobs.")
+    await asyncio.gather(*running, return_exceptions=True)
+    proxy_refresh_task.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())